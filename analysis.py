@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+"""
+    Tools for auditing keys: how long a key's rotors take to come back
+    around, how much of the charset its plugboard covers, how evenly the
+    permutations it steps through spread symbols out, and what the
+    ciphertext it produces looks like. Everything that runs over a lot of
+    positions or data is done with numpy arrays, using the tables from
+    vector.py rather than stepping a machine a symbol at a time.
+
+    Keys can be given as anything subcrypt.Enigma() takes, or as an
+    already compiled engine.Wiring.
+"""
+
+import math
+import numpy as np
+import engine
+import subcrypt
+import vector
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _wiring(key):
+    if isinstance(key, engine.Wiring):
+        return key
+    if type(key) is not str:
+        key = bytes(key)
+    return subcrypt.compile_key(key)
+
+
+def _divisors(n):
+    small = [d for d in range(1, math.isqrt(n) + 1) if n % d == 0]
+    return small + [n // d for d in reversed(small) if d * d != n]
+
+
+def table_period(rotor):
+    """
+        How many turns it takes for an engine.Rotor's transpose table to
+        come back around. This divides the period of its ordering, but can
+        be a lot shorter, since orderings that only differ in the order of
+        the pairs, or of the two halves of a pair, give the same table.
+    """
+    origin = rotor.table(0)
+    for d in _divisors(rotor.period):
+        if rotor.table(d) == origin:
+            return d
+
+
+def carry_period(rotor):
+    """
+        How many turns it takes for the pattern of when an engine.Rotor
+        turns the next one over to repeat, and how many times it does in
+        that many turns. This divides the counter's lap, but can be
+        shorter: a rotor with a shift past the charset size turns the next
+        one over every turn, whatever its counter says.
+    """
+    currents, carried, loop = rotor.schedule
+    lap = len(currents) - 1 - loop
+    steps = [carried[i+1] - carried[i] for i in range(loop, loop + lap)]
+    for d in _divisors(lap):
+        if steps == steps[d:] + steps[:d]:
+            return d, carried[loop + d] - carried[loop]
+
+
+def rotor_report(key):
+    """
+        For every rotor, from the leading one down: its start and shift, how
+        many turns it takes to come back to its starting ordering (period)
+        and transpose table (table_period), how many turns its position
+        counter takes to repeat (lap), and how many times it turns the next
+        rotor over in one lap.
+    """
+    report = []
+    for rotor in reversed(_wiring(key).rotors):
+        currents, carried, loop = rotor.schedule
+        lap = len(currents) - 1 - loop
+        per_lap = carried[loop + lap] - carried[loop]
+        report.append({"start": rotor.start,
+                       "shift": rotor.shift,
+                       "period": rotor.period,
+                       "table_period": table_period(rotor),
+                       "lap": lap,
+                       "carries_per_lap": per_lap,
+                       "carry_rate": per_lap / lap})
+    return report
+
+
+def chain_period(key):
+    """
+        How many symbols it takes for every rotor to be back where it was
+        at once, after which the machine repeats itself. Each rotor comes
+        back around once its turn count is a multiple of both its table
+        period and its carry period, except for the deepest rotor, which
+        turns nothing over so only its table matters. The leading rotor
+        turns once a symbol, so this is worked out rotor by rotor from the
+        leading one down.
+    """
+    rotors = _wiring(key).rotors
+    positions = 1
+    # How many times the rotor being looked at turns in <positions> symbols
+    turns = 1
+    for rotor in reversed(rotors):
+        cycle = table_period(rotor)
+        if rotor is not rotors[0]:
+            lap, per_lap = carry_period(rotor)
+            cycle = cycle * lap // math.gcd(cycle, lap)
+        repeat = cycle // math.gcd(cycle, turns)
+        positions *= repeat
+        if rotor is not rotors[0]:
+            turns = turns * repeat // lap * per_lap
+    return positions
+
+
+def plugboard_coverage(key):
+    """
+        The fraction of the charset the plugboard swaps with something else.
+    """
+    wiring = _wiring(key)
+    plug = np.frombuffer(bytes(wiring.plug), np.uint8)[:wiring.size]
+    return float(np.count_nonzero(plug != np.arange(wiring.size))) / wiring.size
+
+
+def permutations(key, count, position=0):
+    """
+        The permutation every position from <position> on transposes with,
+        as a <count> by charset size array.
+    """
+    return vector.tables(_wiring(key)).permutations(position, count)
+
+
+def permutation_stats(key, count=4096, position=0):
+    """
+        How the permutations over <count> positions are spread out: how
+        many different ones turn up, how many fixed points they have
+        (there should be none, since the machine is reflective), and a
+        chi-squared statistic for how evenly each symbol is paired with
+        every other symbol, along with its degrees of freedom. Every
+        permutation swaps symbols in pairs, so a sent to b always means b
+        sent to a, and each pair is only counted once.
+    """
+    perms = permutations(key, count, position)
+    size = perms.shape[1]
+    distinct = len(np.unique(perms, axis=0))
+    symbols = np.arange(size)
+    fixed = int(np.count_nonzero(perms == symbols))
+    pairs = np.bincount((symbols * size + perms).reshape(-1), minlength=size * size)
+    pairs = pairs.reshape(size, size)[np.triu_indices(size, 1)]
+    expected = count / (size - 1)
+    chi2 = float(((pairs - expected) ** 2).sum() / expected)
+    return {"positions": count,
+            "distinct": distinct,
+            "fixed_points": fixed,
+            "chi2": chi2,
+            # Each of the size*(size-1)/2 pairs turns up at a position with
+            # chance 1/(size-1), independently of the other positions, so
+            # the statistic averages out at this for a well spread key
+            "dof": size * (size - 2) // 2}
+
+
+def histogram(data, counts=None, size=256):
+    """
+        Counts how often each symbol turns up in <data>, adding to <counts>
+        if given so large samples can be counted a chunk at a time.
+    """
+    found = np.bincount(np.frombuffer(data, np.uint8), minlength=size)
+    return found if counts is None else counts + found
+
+
+def index_of_coincidence(counts):
+    """
+        The chance that two symbols picked from the counted data are the
+        same. For uniformly random bytes this is 1/256.
+    """
+    counts = np.asarray(counts, np.float64)
+    total = counts.sum()
+    if total < 2:
+        return 0.0
+    return float((counts * (counts - 1)).sum() / (total * (total - 1)))
+
+
+def histogram_stats(counts):
+    """
+        The index of coincidence of the counted data, along with a
+        chi-squared statistic for how far it is from uniform and the
+        Shannon entropy in bits per symbol.
+    """
+    counts = np.asarray(counts, np.float64)
+    total = counts.sum()
+    expected = total / len(counts)
+    p = counts[counts > 0] / total if total else counts[:0]
+    return {"symbols": int(total),
+            "ioc": index_of_coincidence(counts),
+            "chi2": float(((counts - expected) ** 2).sum() / expected) if total else 0.0,
+            "entropy": float(-(p * np.log2(p)).sum())}
+
+
+def ciphertext_histogram(key, samples, chunk_size=CHUNK_SIZE):
+    """
+        Transposes each sample (bytes, or a file object to read) from the
+        key's initial state and counts the symbols that come out.
+    """
+    tables = vector.tables(_wiring(key))
+    counts = np.zeros(tables.size, np.int64)
+    for sample in samples:
+        if isinstance(sample, (bytes, bytearray, memoryview)):
+            sample = memoryview(sample)
+            chunks = (sample[i:i+chunk_size] for i in range(0, len(sample), chunk_size))
+        else:
+            chunks = iter(lambda: sample.read(chunk_size), b"")
+        position = 0
+        for chunk in chunks:
+            counts = histogram(tables.transpose_threaded(position, chunk), counts, tables.size)
+            position += len(chunk)
+    return counts
+
+
+def audit(key, samples=(), window=4096):
+    """
+        Everything above for one key, as a dict. The ciphertext statistics
+        are only included if there are samples to transpose.
+    """
+    wiring = _wiring(key)
+    period = chain_period(wiring)
+    report = {"rotors": rotor_report(wiring),
+              "chain_period": period,
+              "chain_period_bits": math.log2(period),
+              "plugboard_coverage": plugboard_coverage(wiring),
+              "permutations": permutation_stats(wiring, window)}
+    if samples:
+        report["ciphertext"] = histogram_stats(ciphertext_histogram(wiring, samples))
+    return report
@@ -2,51 +2,559 @@
 
 """
 This file will allow encoding to be performed at the command line.
+
+Any number of files, directories or glob patterns can be given to -e, in
+which case every file found is transposed into the same relative location
+under the -o directory. The work is cut into tasks and spread across a pool
+of worker processes, which all attach to one shared copy of the key's rotor
+tables rather than building their own. Files larger than the chunk size are
+split across several tasks (every chunk just sets its rotors to the chunk's
+offset), while smaller files are batched together so that each task is
+roughly a chunk's worth of work.
+
+With --compress the data is compressed before it is transposed, and with
+--armor the output is written as text. Compressed or armored files can't be
+split into chunks, so each one is streamed by a single worker. Transposing
+a compressed file back decompresses it automatically, while armored input
+has to be asked to be unwrapped with --dearmor.
+
+Startup time matters when transposing lots of small files one at a time, so
+a key is only generated when -g asks for one, and modules only some modes
+need (multiprocessing, threads) are imported when those modes run. --time
+shows where the time went.
 """
 
+import time
+_started = time.perf_counter()
+
 import argparse
+import contextlib
+import glob
+import os
 import subcrypt
 import sys
 
-parser = argparse.ArgumentParser(description="Encode or Decode a file with PyNigma!")
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# The machine belonging to this worker process, the machines for each key it
+# was built from, and the compression and armor methods in use, set up by
+# _init_worker()
+_machine = None
+_machines = []
+_compress = None
+_armor = None
+_dearmor = False
+
+
+def _init_worker(keys, compress=None, tables=None, armor=None, threads=None, dearmor=False):
+    """
+        Builds the one machine a worker will use for every task it is given.
+        Given two keys, the machine re-keys from the first to the second.
+        If <tables> names blocks of shared memory holding the keys' wiring,
+        the worker attaches to those instead of decoding the keys itself.
+        With <threads>, the machines split large pieces of work across that
+        many threads instead. With <dearmor> streamed input is unwrapped
+        from its armor first.
+    """
+    global _machine, _machines, _compress, _armor, _dearmor
+    if tables is not None:
+        import engine
+        _machines = [subcrypt.Enigma.from_wiring(engine.attach(name)) for name in tables]
+    elif threads:
+        _machines = [subcrypt.ThreadedEnigma(key, threads) for key in keys]
+    else:
+        _machines = [subcrypt.Enigma(key) for key in keys]
+    _machine = _machines[0] if len(_machines) == 1 else subcrypt.Rekey(*_machines)
+    _compress = compress
+    _armor = armor
+    _dearmor = dearmor
+
+
+def _run_tasks(tasks):
+    """
+        Transposes a batch of (source, destination, offset, length) pieces
+        into destinations that have already been sized. A length of None
+        means the whole file is streamed through the compression and armor
+        stages instead. Returns the number of bytes processed.
+    """
+    total = 0
+    for src, dst, offset, length in tasks:
+        if length is None:
+            _machine.reset()
+            with open(src, "rb") as f, open(dst, "wb") as out:
+                total += subcrypt.transpose_stream(_machine, f, out, compress=_compress,
+                                                   armor=_armor, dearmor=_dearmor)
+            continue
+        with open(src, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        _machine.seek(offset)
+        with open(dst, "r+b") as f:
+            f.seek(offset)
+            f.write(_machine.transpose(data))
+        total += len(data)
+    return total
+
+
+def _glob_root(pattern):
+    """
+        The leading part of a glob pattern that contains no wildcards, which
+        is what matches get mirrored relative to.
+    """
+    parts = []
+    for part in os.path.normpath(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    if parts == [""]:
+        return os.sep
+    return os.sep.join(parts) or "."
 
-parser.add_argument('-e', "--encrypt", "--decrypt", action="store", dest="will_enc",
-                    help="Encode or Decode a file. Defaults to STDOUT if -o is not given.")
-parser.add_argument('-o', '--output', action="store", dest="out", metavar='OutFile', type=str,
-                    help="The file to write the output to.")
-parser.add_argument('-g', '--generate', action="store", dest="genfile", type=str, metavar='keyfile',
-                    help="Generate a key and store it in a file")
-parser.add_argument('-r', '--read-key', action="store", dest="readfile", type=str, metavar='keyfile',
-                    help="Read a key from a file")
 
-args = parser.parse_args()
+def find_files(targets):
+    """
+        Expands files, directories and glob patterns into a list of
+        (source, relative path) pairs. Anything else that exists, such as a
+        pipe, is taken as a single file.
+    """
+    found = []
+    for target in targets:
+        # Anything that exists is taken literally, even if it looks like
+        # a pattern (say, data[1].bin)
+        if os.path.isdir(target):
+            for root, dirs, files in os.walk(target):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    found.append((path, os.path.relpath(path, target)))
+        elif os.path.exists(target):
+            found.append((target, os.path.basename(target)))
+        elif glob.has_magic(target):
+            base = _glob_root(target)
+            for path in sorted(glob.glob(target, recursive=True)):
+                if os.path.isfile(path):
+                    found.append((path, os.path.relpath(path, base)))
+        else:
+            raise Exception(f"No such file or directory: {target}")
+    return found
 
 
-if args.out and not args.will_enc:
-    print("Incompatible arguments, need something to transpose!")
-    exit(1)
+def check_pairs(pairs):
+    """
+        Makes sure no source is also a destination and no two sources go to
+        the same destination, since destinations are written to while the
+        sources are still being read.
+    """
+    sources = {os.path.realpath(src) for src, _ in pairs}
+    seen = set()
+    for src, dst in pairs:
+        real = os.path.realpath(dst)
+        if real in sources or (os.path.exists(dst) and os.path.samefile(src, dst)):
+            raise Exception(f"Refusing to overwrite {src} with its own output!")
+        if real in seen:
+            raise Exception(f"More than one file would be written to {dst}!")
+        seen.add(real)
 
-if args.will_enc and not (args.genfile or args.readfile):
-    print("Incompatible arguments, if no supplied key, where should it be written?")
-    exit(1)
 
-# Generate a key regardless, it can be overwritten later
-key = subcrypt.generate_key()
+def plan_tasks(pairs, chunk_size, machine, compress=None, armor=None, dearmor=False):
+    """
+        Creates (and sizes) every destination file, then cuts the work into
+        tasks of roughly <chunk_size> bytes each. Files being compressed,
+        armored or dearmored, and files whose start transposes to a
+        compression header are left whole, as is anything that isn't a
+        regular file (a pipe, say), which can only be read through once.
+    """
+    tasks = []
+    batch, batched = [], 0
+    for src, dst in pairs:
+        size = os.path.getsize(src)
+        if os.path.dirname(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        streamed = compress is not None or armor is not None or dearmor or \
+            not os.path.isfile(src)
+        if not streamed:
+            with open(src, "rb") as f:
+                head = f.read(subcrypt.HEADER_PEEK)
+            streamed = subcrypt.peek_compression(machine, head) is not None
+        if streamed:
+            if size > chunk_size:
+                tasks.append([(src, dst, 0, None)])
+                continue
+            batch.append((src, dst, 0, None))
+            batched += size
+            if batched >= chunk_size:
+                tasks.append(batch)
+                batch, batched = [], 0
+            continue
+        with open(dst, "wb") as f:
+            f.truncate(size)
+        if size > chunk_size:
+            for offset in range(0, size, chunk_size):
+                tasks.append([(src, dst, offset, min(chunk_size, size - offset))])
+            continue
+        batch.append((src, dst, 0, size))
+        batched += size
+        if batched >= chunk_size:
+            tasks.append(batch)
+            batch, batched = [], 0
+    if batch:
+        tasks.append(batch)
+    return tasks
 
-if args.genfile:
-    subcrypt.write_key_file(key, args.genfile)
 
-if args.readfile:
-    key = subcrypt.read_key_file(args.readfile)
+@contextlib.contextmanager
+def _worker_pool(keys, jobs, compress=None, armor=None, dearmor=False):
+    """
+        A pool of worker processes. Workers share one copy of the rotor
+        tables rather than each decoding the keys and building their own.
+    """
+    import engine
+    from concurrent.futures import ProcessPoolExecutor
+    shared = [engine.share(m.wiring) for m in _machines]
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(keys, compress, [shm.name for shm in shared],
+                                           armor, None, dearmor)) as pool:
+            yield pool
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
 
-if args.will_enc:
-    e = subcrypt.Enigma(key)
-    with open(args.will_enc, "rb") as f:
-        data = f.read()
-    result = e.transpose(data)
 
-    if args.out:
-        with open(args.out, "wb") as f:
-            f.write(result)
+def _summary(count, total, elapsed):
+    rate = total / elapsed / (1024 * 1024) if elapsed else 0.0
+    print(f"{count} file(s), {total} bytes in {elapsed:.2f}s ({rate:.2f} MiB/s)",
+          file=sys.stderr)
+
+
+def run(keys, pairs, jobs, chunk_size, compress=None, armor=None, threads=None,
+        dearmor=False):
+    """
+        Transposes every (source, destination) pair and prints a summary.
+    """
+    started = time.perf_counter()
+    _init_worker(keys, compress, armor=armor, threads=threads, dearmor=dearmor)
+    tasks = plan_tasks(pairs, chunk_size, _machine, compress, armor, dearmor)
+    # Pipes and the like may not be open to the workers, so they are only
+    # read in this process
+    if jobs > 1 and len(tasks) > 1 and all(os.path.isfile(src) for src, _ in pairs):
+        with _worker_pool(keys, jobs, compress, armor, dearmor) as pool:
+            total = sum(pool.map(_run_tasks, tasks))
     else:
-        sys.stdout.write(result)
+        total = sum(_run_tasks(t) for t in tasks)
+    _summary(len(pairs), total, time.perf_counter() - started)
+
+
+def run_append(keys, pairs, chunk_size):
+    """
+        Transposes each source onto the end of its (already transposed)
+        destination, carrying on where the destination leaves off, and
+        prints a summary.
+    """
+    started = time.perf_counter()
+    _init_worker(keys)
+    total = 0
+    for src, dst in pairs:
+        if os.path.dirname(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with open(src, "rb") as f:
+            total += subcrypt.append_stream(_machine, f, dst, chunk_size)
+    _summary(len(pairs), total, time.perf_counter() - started)
+
+
+def _transpose_chunk(offset, data):
+    """
+        Transposes one chunk in a worker, returning it along with how long
+        that took.
+    """
+    started = time.perf_counter()
+    _machine.seek(offset)
+    return _machine.transpose(data), time.perf_counter() - started
+
+
+def run_pipelined(keys, pairs, jobs, chunk_size, depth, compress=None, armor=None,
+                  threads=None, dearmor=False):
+    """
+        Transposes every (source, destination) pair with reading, transposing
+        and writing overlapped. A reader thread reads chunks ahead into a
+        queue, this thread transposes them (handing them to worker processes
+        if there is more than one job) and a writer thread writes the results
+        out in order. Both queues hold at most <depth> chunks. Prints a
+        summary, and how long each stage spent working (for the workers,
+        added up across all of them).
+    """
+    import queue
+    import threading
+    started = time.perf_counter()
+    _init_worker(keys, compress, armor=armor, threads=threads, dearmor=dearmor)
+    busy = {"read": 0.0, "transpose": 0.0, "write": 0.0}
+    reads = queue.Queue(depth)
+    writes = queue.Queue(depth)
+    errors = []
+
+    def reader():
+        try:
+            for src, dst in pairs:
+                with open(src, "rb") as f:
+                    offset = 0
+                    # The first chunk has to be big enough to spot a header
+                    tick = time.perf_counter()
+                    data = f.read(max(chunk_size, subcrypt.HEADER_PEEK))
+                    busy["read"] += time.perf_counter() - tick
+                    while True:
+                        tick = time.perf_counter()
+                        following = f.read(chunk_size) if data else b""
+                        busy["read"] += time.perf_counter() - tick
+                        reads.put((dst, offset, data, not following))
+                        if not following:
+                            break
+                        offset += len(data)
+                        data = following
+        except Exception as e:
+            errors.append(e)
+        finally:
+            reads.put(None)
+
+    def writer():
+        current, f = None, None
+        try:
+            while True:
+                item = writes.get()
+                if item is None:
+                    break
+                if errors:
+                    continue
+                dst, out = item
+                if not isinstance(out, bytes):
+                    out, took = out.result()
+                    busy["transpose"] += took
+                tick = time.perf_counter()
+                if dst != current:
+                    if f is not None:
+                        f.close()
+                    if os.path.dirname(dst):
+                        os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    f, current = open(dst, "wb"), dst
+                f.write(out)
+                busy["write"] += time.perf_counter() - tick
+        except Exception as e:
+            errors.append(e)
+            # Keep the queue moving so the other stages can finish
+            while writes.get() is not None:
+                pass
+        finally:
+            if f is not None:
+                f.close()
+
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    for t in threads:
+        t.start()
+    total = 0
+    with contextlib.ExitStack() as stack:
+        pool = stack.enter_context(_worker_pool(keys, jobs, compress, armor, dearmor)) \
+            if jobs > 1 else None
+        try:
+            stream = None
+            while True:
+                item = reads.get()
+                if item is None:
+                    break
+                dst, offset, data, last = item
+                total += len(data)
+                if errors:
+                    continue
+                tick = time.perf_counter()
+                if offset == 0:
+                    # Compressed and armored streams have to be run through
+                    # in order, anything else can be cut up between the workers
+                    stream = None
+                    if pool is None or compress is not None or armor is not None or \
+                            dearmor or subcrypt.peek_compression(_machine, data) is not None:
+                        _machine.reset()
+                        stream = subcrypt.Transposer(_machine, compress, armor, dearmor)
+                if stream is not None:
+                    out = stream.update(data)
+                    if last:
+                        out += stream.finish()
+                    busy["transpose"] += time.perf_counter() - tick
+                else:
+                    out = pool.submit(_transpose_chunk, offset, data)
+                writes.put((dst, out))
+        except Exception as e:
+            errors.append(e)
+            while reads.get() is not None:
+                pass
+        finally:
+            writes.put(None)
+            for t in threads:
+                t.join()
+    if errors:
+        raise errors[0]
+    _summary(len(pairs), total, time.perf_counter() - started)
+    print(f"read {busy['read']:.2f}s, transpose {busy['transpose']:.2f}s, "
+          f"write {busy['write']:.2f}s", file=sys.stderr)
+
+
+def _report(phases):
+    print(", ".join(f"{name} {secs * 1000:.1f}ms" for name, secs in phases),
+          file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode or Decode a file with PyNigma!")
+
+    parser.add_argument('-e', "--encrypt", "--decrypt", action="store", dest="will_enc",
+                        nargs='+', metavar='PATH',
+                        help="Encode or Decode files, directories or glob patterns. "
+                             "Defaults to STDOUT if -o is not given.")
+    parser.add_argument('-o', '--output', action="store", dest="out", metavar='OutFile', type=str,
+                        help="The file to write the output to, or the directory to mirror "
+                             "the input tree into.")
+    parser.add_argument('-g', '--generate', action="store", dest="genfile", type=str, metavar='keyfile',
+                        help="Generate a key and store it in a file")
+    parser.add_argument('-r', '--read-key', action="store", dest="readfile", type=str, metavar='keyfile',
+                        help="Read a key from a file")
+    parser.add_argument('--rekey', action="store", dest="rekey", nargs=2, type=str,
+                        metavar=('old.key', 'new.key'),
+                        help="Re-key files transposed with one key so they are transposed "
+                             "with another, in one pass and without writing out plaintext.")
+    parser.add_argument('--append', action="store_true", dest="append",
+                        help="Add the transposed input onto the end of the (already "
+                             "transposed) output rather than replacing it.")
+    parser.add_argument('--write-pad', action="store", dest="padfile", type=str, metavar='padfile',
+                        help="Work out the permutations for the start of the key's stream "
+                             "ahead of time and write them to a pad file. Needs numpy.")
+    parser.add_argument('--window', action="store", dest="window", type=int,
+                        default=64 * 1024, metavar='bytes',
+                        help="How many positions the pad file covers. Each one takes "
+                             "256 bytes.")
+    parser.add_argument('-j', '--jobs', action="store", dest="jobs", type=int,
+                        default=os.cpu_count() or 1,
+                        help="Number of worker processes to use. Defaults to the CPU count.")
+    parser.add_argument('--threads', action="store_true", dest="threads",
+                        help="Run the jobs as threads in this process rather than as "
+                             "worker processes. Needs numpy.")
+    parser.add_argument('--chunk-size', action="store", dest="chunk_size", type=int,
+                        default=CHUNK_SIZE, metavar='bytes',
+                        help="Split files larger than this across workers, and batch "
+                             "smaller ones up to this size.")
+    parser.add_argument('--compress', action="store", dest="compress",
+                        choices=sorted(subcrypt.COMPRESSORS),
+                        help="Compress the data before transposing it. Decompression "
+                             "happens automatically when transposing back.")
+    parser.add_argument('--pipeline', action="store_true", dest="pipeline",
+                        help="Overlap reading, transposing and writing, with chunks "
+                             "read ahead and written behind in their own threads.")
+    parser.add_argument('--queue-depth', action="store", dest="depth", type=int, default=4,
+                        metavar='chunks',
+                        help="How many chunks may wait between pipeline stages.")
+    parser.add_argument('--armor', action="store", dest="armor",
+                        choices=sorted(subcrypt.ARMORS),
+                        help="Write the output as text.")
+    parser.add_argument('--dearmor', action="store_true", dest="dearmor",
+                        help="The input is armored text, unwrap it before transposing.")
+    parser.add_argument('--time', action="store_true", dest="timing",
+                        help="Report how long startup, loading the key and "
+                             "transposing took.")
+
+    args = parser.parse_args()
+    phases = [("startup", time.perf_counter() - _started)]
+
+    if args.out and not args.will_enc:
+        print("Incompatible arguments, need something to transpose!")
+        exit(1)
+
+    if args.will_enc and not (args.genfile or args.readfile or args.rekey):
+        print("Incompatible arguments, if no supplied key, where should it be written?")
+        exit(1)
+
+    if args.rekey and (args.readfile or args.compress or not args.will_enc):
+        print("Incompatible arguments, --rekey takes both keys and needs something to re-key!")
+        exit(1)
+
+    if args.append and (args.compress or args.armor or args.dearmor or not args.out):
+        print("Incompatible arguments, --append needs an output and can't compress or armor!")
+        exit(1)
+
+    if args.padfile and not (args.genfile or args.readfile):
+        print("Incompatible arguments, a pad file needs a key to be made from!")
+        exit(1)
+
+    if args.chunk_size < 1 or args.jobs < 1 or args.depth < 1:
+        print("The chunk size, number of jobs and queue depth must be at least 1!")
+        exit(1)
+
+    # With --threads there is only the one process, working on -j threads
+    jobs, threads = (1, args.jobs) if args.threads else (args.jobs, None)
+
+    tick = time.perf_counter()
+    keys = []
+    if args.genfile:
+        keys = [subcrypt.generate_key()]
+        subcrypt.write_key_file(keys[0], args.genfile)
+
+    if args.readfile:
+        keys = [subcrypt.read_key_file(args.readfile)]
+
+    if args.rekey:
+        keys = [subcrypt.read_key_file(k) for k in args.rekey]
+
+    if args.will_enc:
+        _init_worker(keys, args.compress, armor=args.armor, threads=threads,
+                     dearmor=args.dearmor)
+    phases.append(("key", time.perf_counter() - tick))
+
+    if args.padfile:
+        tick = time.perf_counter()
+        subcrypt.write_pad(keys[0], args.padfile, args.window)
+        phases.append(("pad", time.perf_counter() - tick))
+    tick = time.perf_counter()
+
+    def go(keys, pairs):
+        if args.append:
+            run_append(keys, pairs, args.chunk_size)
+        elif args.pipeline:
+            run_pipelined(keys, pairs, jobs, args.chunk_size, args.depth,
+                          args.compress, args.armor, threads, args.dearmor)
+        else:
+            run(keys, pairs, jobs, args.chunk_size, args.compress, args.armor, threads,
+                args.dearmor)
+
+    if args.will_enc:
+        single = (len(args.will_enc) == 1 and os.path.exists(args.will_enc[0])
+                  and not os.path.isdir(args.will_enc[0]))
+
+        try:
+            if single and not args.out:
+                pairs = None
+            elif single and not os.path.isdir(args.out):
+                pairs = [(args.will_enc[0], args.out)]
+            else:
+                found = find_files(args.will_enc)
+                if not args.out:
+                    print("An output directory (-o) is needed when transposing more than one file!")
+                    exit(1)
+                pairs = [(src, os.path.join(args.out, rel)) for src, rel in found]
+            if pairs is not None:
+                check_pairs(pairs)
+        except Exception as e:
+            print(e)
+            exit(1)
+
+        if pairs is None:
+            with open(args.will_enc[0], "rb") as f:
+                subcrypt.transpose_stream(_machine, f, sys.stdout.buffer,
+                                          compress=args.compress, armor=args.armor,
+                                          dearmor=args.dearmor)
+            sys.stdout.flush()
+        else:
+            go(keys, pairs)
+    phases.append(("transpose", time.perf_counter() - tick))
+
+    if args.timing:
+        _report(phases)
+
+
+if __name__ == "__main__":
+    main()
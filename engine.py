@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+
+"""
+    The rotor engine shared by enigma.py, subcrypt.py and enigmayaml.py.
+    Everything in here works on symbol indices rather than characters or
+    bytes: a charset of size N is just the numbers 0 through N-1, and it is
+    up to each front-end to map its own symbols onto those. The charset
+    size has to be even and no bigger than 256.
+
+    Every table here is kept as 256 bytes, where anything past the end of
+    the charset maps to itself. That way any table can be handed to
+    bytes.translate(), which does all of the heavy lifting in C.
+
+    The rotors and plugboard for a key are compiled once into a Wiring,
+    which never changes and can be shared by any number of machines. A
+    Machine itself only holds how far each of its rotors has turned.
+"""
+
+import math
+import mmap
+import struct
+import sys
+from array import array
+
+MAX_SIZE = 256
+_IDENTITY = bytes(range(MAX_SIZE))
+
+# Layout of a wiring flattened out by Wiring.to_bytes(): a header, the
+# plugboard, then for each rotor its settings followed by its tables. Every
+# piece is a multiple of 8 bytes long so the counters line up.
+WIRING_MAGIC = b"PYNW"
+WIRING_VERSION = 1
+_HEADER = struct.Struct('<4sHHI4x')
+_ROTOR = struct.Struct('<qqqqqqB7x')
+
+
+def identity():
+    """
+        A table that maps everything to itself.
+    """
+    return _IDENTITY
+
+
+def invert(table):
+    """
+        The inverse of a permutation table.
+    """
+    inverse = bytearray(MAX_SIZE)
+    for i, c in enumerate(table):
+        inverse[c] = i
+    return bytes(inverse)
+
+
+def pad(symbols):
+    """
+        Pads a sequence of indices out to a full 256 byte table.
+    """
+    symbols = bytes(symbols)
+    return symbols + bytes(range(len(symbols), MAX_SIZE))
+
+
+def plug_table(pairs):
+    """
+        Builds a plugboard table from (from, to) index pairs.
+    """
+    table = bytearray(identity())
+    for i_from, i_to in pairs:
+        table[i_from] = i_to
+        table[i_to] = i_from
+    return bytes(table)
+
+
+def turn_table(amount, size, swap=False):
+    """
+        The position permutation applied by turning a rotor <amount> times:
+        the rotor's ordering is rotated, cut in half, and the halves are
+        zipped back together. <swap> swaps every zipped pair around, which is
+        how rotors that are rotated by their values rather than their keys
+        turn. Returns it along with its inverse, as translate() tables.
+    """
+    half = int(size/2)
+    step = bytearray(identity())
+    for i in range(half):
+        left, right = (i + amount) % size, (i + half + amount) % size
+        if swap:
+            left, right = right, left
+        step[2*i] = left
+        step[2*i+1] = right
+    return bytes(step), invert(step)
+
+
+def _pairs(size):
+    """
+        Position of each slot's partner in a rotor ordering.
+    """
+    return bytes(i ^ 1 if i < size else i for i in range(MAX_SIZE))
+
+
+def _period(step, size):
+    """
+        How many turns it takes for the turn permutation to come back
+        around, which is the lowest common multiple of its cycle lengths.
+    """
+    seen = [False] * size
+    period = 1
+    for i in range(size):
+        length = 0
+        j = i
+        while not seen[j]:
+            seen[j] = True
+            j = step[j]
+            length += 1
+        if length:
+            period = period * length // math.gcd(period, length)
+    return period
+
+
+class PlugBoard:
+    # The front-end's symbols, in index order
+    charset = range(MAX_SIZE)
+
+    def __init__(self, plugformat=None):
+        """
+        Initializes a plugboard. The plugboard is a substitution cipher
+        that is fixed. It accepts a string as the plugformat parameter,
+        which should be specified as 'A-B|C-D|E-J' etc. The first symbol
+        followed by a dash, then the symbol it will transpose to. Note
+        that overlaps will be met with an Exception, so A -> B and B -> C
+        will throw an error and refuse to run. The plugformat must be
+        cyclical! A = B and B = A. An exception will be thrown if so.
+        The plugformat will be read in and missing symbols will not be
+        transposed, but if one symbol is transposed its compliment will
+        be transposed back automatically. How each side of a pair is
+        written is up to the front-end, see symbol().
+        """
+        self.plugformat = plugformat
+        self.table = plug_table(self._pairs())
+        self.transpose_table = {c: self.charset[i] for c, i in zip(self.charset, self.table)}
+
+    def symbol(self, text):
+        """
+        The index of one side of a pair, or None to skip the pair. Raises
+        ValueError if it can't be read. By default, sides are indices.
+        """
+        i = int(text)
+        if not 0 <= i < len(self.charset):
+            raise ValueError(text)
+        return i
+
+    def _pairs(self):
+        """
+        Reads the plugformat into (from, to) index pairs.
+        """
+        pairs = []
+        if self.plugformat is None:
+            # No substitution, call it a day.
+            return pairs
+        seen = set()
+        try:
+            for inst in self.plugformat.split('|'):
+                if not inst:
+                    continue
+                i_from, i_to = [self.symbol(side) for side in inst.split('-')]
+                if i_from is None or i_to is None:
+                    continue
+                if i_from in seen or i_to in seen:
+                    # We have overlap!
+                    raise Exception("Overlap in plugboard format!")
+                seen.update((i_from, i_to))
+                pairs.append((i_from, i_to))
+        except ValueError:
+            raise Exception("Please follow plugformat of a-b|c-d|d-e")
+        return pairs
+
+    def transpose(self, c):
+        """
+        The official function to transpose a symbol via the plugboard
+        """
+        return self.transpose_table[c]
+
+
+class Rotor:
+    __slots__ = ('start', 'shift', 'next_rotor', 'size', 'swap', 'pairs',
+                 'origin_order', 'origin_inverse', 'step', 'unstep',
+                 'period', 'powers', 'schedule')
+
+    def __init__(self, order, start=0, shift=1, r=None, size=MAX_SIZE, swap=False):
+        """
+        A rotor working on symbol indices.
+        order := the ordering of the charset the rotor starts out with
+        start := what position to set the rotor to
+        shift := how many positions to shift for each rotation
+        r := pointer to another initialized rotor instance, this
+             is the rotor next in line
+        size := the size of the charset
+        swap := see turn_table()
+
+        The rotor is kept as an ordering of the charset, where neighbouring
+        pairs (0 and 1, 2 and 3, ...) transpose to each other, along with the
+        inverse of that ordering. Turning the rotor is then a fixed
+        permutation of the ordering. The permutation raised to every power
+        of two is kept as well, so the rotor's state after any number of
+        turns can be put together from a handful of them.
+
+        A rotor holds no state of its own: it is only ever read from once
+        built, and its state is worked out from a turn count with state().
+        """
+        if size % 2 or size > MAX_SIZE:
+            raise Exception("Charset length must be even and at most 256!")
+        self.start = start
+        self.shift = shift
+        self.next_rotor = r
+        self.size = size
+        self.swap = swap
+        self.pairs = _pairs(size)
+        step, unstep = turn_table(start % size, size, swap)
+        self.origin_order = step.translate(pad(order))
+        self.origin_inverse = invert(self.origin_order)
+        self.step, self.unstep = turn_table(shift % size, size, swap)
+        self.period = _period(self.step, size)
+        powers = []
+        step, unstep = self.step, self.unstep
+        for _ in range(self.period.bit_length()):
+            powers.append((step, unstep))
+            step, unstep = step.translate(step), unstep.translate(unstep)
+        self.powers = tuple(powers)
+        self.schedule = self._carry_schedule()
+
+    def _carry_schedule(self):
+        """
+        Plays the rotor's position counter forward until it repeats. Returns
+        the counter value and running carry count at each turn, along with
+        where the repeating part of the sequence starts.
+        """
+        seen = {}
+        currents = [self.start]
+        carried = [0]
+        current, total = self.start, 0
+        while current not in seen:
+            seen[current] = len(currents) - 1
+            current += self.shift
+            if current > self.size:
+                current %= self.size
+                total += 1
+            currents.append(current)
+            carried.append(total)
+        return tuple(currents), tuple(carried), seen[current]
+
+    def counter(self, turns):
+        """
+        Returns the position counter and number of carries after <turns>
+        turns of the rotor.
+        """
+        currents, carried, loop = self.schedule
+        if turns < len(currents):
+            return currents[turns], carried[turns]
+        length = len(currents) - 1 - loop
+        laps, rest = divmod(turns - loop, length)
+        per_lap = carried[loop + length] - carried[loop]
+        return currents[loop + rest], carried[loop + rest] + laps * per_lap
+
+    def carries(self, turns):
+        """
+        How many times this rotor turns the next one over in <turns> turns.
+        """
+        return self.counter(turns)[1]
+
+    def state(self, turns):
+        """
+        The rotor's ordering and its inverse after <turns> turns from its
+        start position.
+        """
+        turns %= self.period
+        power = unpower = _IDENTITY
+        k = 0
+        while turns:
+            if turns & 1:
+                step, unstep = self.powers[k]
+                power = power.translate(step)
+                unpower = unpower.translate(unstep)
+            turns >>= 1
+            k += 1
+        return power.translate(self.origin_order), bytes(self.origin_inverse).translate(unpower)
+
+    def table(self, turns=0):
+        """
+        The rotor's transpose table after <turns> turns.
+        """
+        order, inverse = self.state(turns)
+        return inverse.translate(bytes(self.pairs).translate(order))
+
+
+class Wiring:
+    __slots__ = ('rotors', 'plug', 'size', 'source')
+
+    def __init__(self, rotors, plug=None, size=MAX_SIZE):
+        """
+            Everything about a machine that comes from its key. <rotors> are
+            chained together the same way the front-ends set them up, each
+            one pointing at the one before it in the list, and the last rotor
+            in the list is the first to be hit. <plug> is the plugboard as a
+            translate() table.
+        """
+        self.rotors = tuple(rotors)
+        self.plug = plug if plug is not None else identity()
+        self.size = size
+        # Whatever owns the buffer the tables live in, if they were attached
+        # from one rather than built
+        self.source = None
+
+    def footprint(self):
+        """
+            Roughly how many bytes the wiring takes up. This is shared by
+            every machine built from it.
+        """
+        total = sys.getsizeof(self) + sys.getsizeof(self.rotors) + sys.getsizeof(self.plug)
+        for rotor in self.rotors:
+            total += sys.getsizeof(rotor)
+            total += sum(sys.getsizeof(t) for t in (rotor.pairs, rotor.origin_order,
+                                                    rotor.origin_inverse, rotor.step,
+                                                    rotor.unstep))
+            total += sum(sys.getsizeof(s) + sys.getsizeof(u) for s, u in rotor.powers)
+            total += sum(sys.getsizeof(part) for part in rotor.schedule[:2])
+        return total
+
+    def to_bytes(self):
+        """
+            Flattens the wiring into one buffer, which from_buffer() can use
+            as it is without copying or rebuilding anything.
+        """
+        parts = [_HEADER.pack(WIRING_MAGIC, WIRING_VERSION, self.size, len(self.rotors)),
+                 bytes(self.plug)]
+        for rotor in self.rotors:
+            currents, carried, loop = rotor.schedule
+            parts.append(_ROTOR.pack(rotor.start, rotor.shift, rotor.period,
+                                     len(rotor.powers), len(currents), loop, rotor.swap))
+            parts += [bytes(rotor.pairs), bytes(rotor.origin_order), bytes(rotor.origin_inverse),
+                      bytes(rotor.step), bytes(rotor.unstep)]
+            for step, unstep in rotor.powers:
+                parts += [bytes(step), bytes(unstep)]
+            parts += [array('q', currents).tobytes(), array('q', carried).tobytes()]
+        return b''.join(parts)
+
+    @classmethod
+    def from_buffer(cls, buf, source=None):
+        """
+            Builds a wiring on top of a buffer written by to_bytes(). The
+            tables are read-only views into <buf> rather than copies, so many
+            processes can share one copy of them. <source> is kept alive for
+            as long as the wiring is.
+        """
+        view = memoryview(buf).toreadonly()
+        magic, version, size, count = _HEADER.unpack_from(view, 0)
+        if magic != WIRING_MAGIC or version != WIRING_VERSION:
+            raise Exception("Not a pynigma wiring table!")
+        offset = _HEADER.size
+
+        def take(length):
+            nonlocal offset
+            offset += length
+            return view[offset-length:offset]
+
+        plug = take(MAX_SIZE)
+        rotors = []
+        for _ in range(count):
+            start, shift, period, powers, schedule, loop, swap = _ROTOR.unpack_from(view, offset)
+            offset += _ROTOR.size
+            rotor = Rotor.__new__(Rotor)
+            rotor.start, rotor.shift, rotor.period = start, shift, period
+            rotor.next_rotor = rotors[-1] if rotors else None
+            rotor.size, rotor.swap = size, bool(swap)
+            rotor.pairs = take(MAX_SIZE)
+            rotor.origin_order = take(MAX_SIZE)
+            rotor.origin_inverse = take(MAX_SIZE)
+            rotor.step = take(MAX_SIZE)
+            rotor.unstep = take(MAX_SIZE)
+            rotor.powers = tuple((take(MAX_SIZE), take(MAX_SIZE)) for _ in range(powers))
+            rotor.schedule = (take(8 * schedule).cast('q'), take(8 * schedule).cast('q'), loop)
+            rotors.append(rotor)
+        wiring = cls(rotors, plug, size)
+        wiring.source = source
+        return wiring
+
+
+def share(wiring):
+    """
+        Copies a wiring into a new block of shared memory, for other
+        processes to attach() to by its name. The caller owns the block and
+        should close() and unlink() it once everyone is done with it.
+    """
+    # Imported here, since it pulls in most of multiprocessing with it
+    from multiprocessing import shared_memory
+    data = wiring.to_bytes()
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    return shm
+
+
+def attach(name):
+    """
+        Attaches read-only to a wiring put in shared memory by share().
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    return Wiring.from_buffer(shm.buf, source=shm)
+
+
+def save(wiring, filename):
+    """
+        Writes a wiring out to a cache file that load() can map back in.
+    """
+    with open(filename, "wb") as f:
+        f.write(wiring.to_bytes())
+
+
+def load(filename):
+    """
+        Memory-maps a wiring cache file written by save(). Every process
+        that loads the same file shares the same pages of it.
+    """
+    try:
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        raise Exception("Wiring cache file not found!")
+    return Wiring.from_buffer(mapped, source=mapped)
+
+
+def build_wiring(rotor_specs, plug, size, rotor=Rotor):
+    """
+        Builds a Wiring out of rotor settings, however a front-end keeps
+        them. Each entry of <rotor_specs> is a dict of keyword arguments
+        for the <rotor> factory, which is also handed the rotor built just
+        before it as r, so every rotor points at the one before it in the
+        list. <plug> is the plugboard as a translate() table.
+    """
+    rotors = []
+    for spec in rotor_specs:
+        rotors.append(rotor(r=rotors[-1] if rotors else None, **spec))
+    return Wiring(rotors, plug, size)
+
+
+def compile_key(key, rotor, plugboard, plugformat=None):
+    """
+        Builds a Wiring out of a key decoded by a front-end's read_key().
+        <rotor> and <plugboard> are the front-end's Rotor and PlugBoard.
+        <plugformat> picks the key's plugboard pairs; by default they are
+        taken as they are.
+    """
+    rotors = ({'tpose': r['rotor'], 'start': r['start'], 'shift': r['shift']}
+              for r in key["rotors"])
+    plug = plugboard(plugformat=plugformat(key) if plugformat else key['plugboard'])
+    return build_wiring(rotors, plug.table, len(plug.charset), rotor)
+
+
+class Machine:
+    __slots__ = ('wiring', 'position', 'offsets')
+
+    def __init__(self, wiring):
+        """
+            The machine itself. All it keeps is the (shared) wiring, how many
+            symbols it has transposed, and how many times each rotor has
+            turned. The tables to work with are put together from those at
+            the start of every transpose() and thrown away at the end.
+        """
+        self.wiring = wiring
+        self.position = 0
+        self.offsets = array('q', bytes(8 * len(wiring.rotors)))
+
+    @classmethod
+    def from_wiring(cls, wiring):
+        """
+            Builds a machine around wiring that has already been put
+            together, such as one attached from shared memory, without
+            going through the front-end's key handling.
+        """
+        machine = cls.__new__(cls)
+        Machine.__init__(machine, wiring)
+        return machine
+
+    @property
+    def rotors(self):
+        return self.wiring.rotors
+
+    def seek(self, position):
+        """
+            Sets every rotor to the state it would be in after <position>
+            symbols had been transposed from the initial state, without
+            replaying them. The leading rotor turns once per symbol and every
+            rotor further down the line turns once per carry of the rotor
+            before it, so each rotor's turn count is worked out in order.
+        """
+        if position < 0:
+            raise Exception("Cannot seek to a negative position!")
+        turns = position
+        for k in range(len(self.offsets) - 1, -1, -1):
+            self.offsets[k] = turns
+            turns = self.wiring.rotors[k].carries(turns)
+        self.position = position
+
+    def reset(self):
+        """
+            Puts the machine back to its initial rotor settings.
+        """
+        self.seek(0)
+
+    def footprint(self):
+        """
+            Roughly how many bytes this machine takes up on its own, leaving
+            out the wiring it shares with other machines for the same key.
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self.offsets) + sys.getsizeof(self.position)
+
+    @staticmethod
+    def _compose(tables, levels, lowest):
+        """
+            Composes every rotor past the leading one into a single table,
+            since those only change when the leading rotor carries over.
+            levels[k] holds rotors 0 through k wired together, so only the
+            levels from <lowest> (the deepest rotor that turned) up need to
+            be rebuilt. Returns the table for all of them, or None when
+            there is only the one rotor.
+        """
+        if not levels:
+            return None
+        for k in range(lowest, len(levels)):
+            t = tables[k]
+            if k == 0:
+                levels[k] = t
+            else:
+                levels[k] = t.translate(levels[k-1]).translate(t)
+        return levels[-1]
+
+    def transpose(self, data):
+        """
+            Transposes a sequence of symbol indices, returning the result
+            as bytes.
+        """
+        res = bytearray(len(data))
+        rotors, size = self.wiring.rotors, self.wiring.size
+        offsets = self.offsets
+        lead = rotors[-1]
+        depth = len(rotors) - 1
+        # The wiring may live in a shared buffer, and translate() has to be
+        # called on real bytes, so take copies of the tables used that way
+        plug = bytes(self.wiring.plug)
+        steps = [bytes(r.step) for r in rotors]
+        pairs = [bytes(r.pairs) for r in rotors]
+
+        # Working copies of the rotors past the leading one, which only turn
+        # when it carries over
+        orders, inverses, currents, tables = [], [], [], []
+        for k in range(depth):
+            order, inverse = rotors[k].state(offsets[k])
+            orders.append(order)
+            inverses.append(inverse)
+            currents.append(rotors[k].counter(offsets[k])[0])
+            tables.append(inverse.translate(pairs[k].translate(order)))
+        levels = [None] * depth
+        inner = self._compose(tables, levels, 0)
+
+        # The plugboard is folded into the leading rotor and the inner table
+        # rather than applied on its own. With P the plugboard, the leading
+        # rotor's inverse becomes inverse∘P (into) and its ordering P∘order
+        # (out of). Both still turn the same way, and the wiring in between
+        # becomes P∘inner∘P.
+        order, inverse = lead.state(offsets[-1])
+        into = plug.translate(inverse)
+        out = order.translate(plug)
+        if inner is not None:
+            inner = plug.translate(inner).translate(plug)
+        step, unstep = steps[-1], lead.unstep
+        current, shift = lead.counter(offsets[-1])[0], lead.shift
+        for i, c in enumerate(data):
+            out = step.translate(out)
+            into = into.translate(unstep)
+            current += shift
+            if current > size:
+                current %= size
+                if inner is not None:
+                    # Turn the next rotor, and any it carries over into
+                    k = depth - 1
+                    while True:
+                        rotor = rotors[k]
+                        orders[k] = steps[k].translate(orders[k])
+                        inverses[k] = inverses[k].translate(rotor.unstep)
+                        tables[k] = inverses[k].translate(pairs[k].translate(orders[k]))
+                        offsets[k] += 1
+                        currents[k] += rotor.shift
+                        if currents[k] <= size:
+                            break
+                        currents[k] %= size
+                        if k == 0:
+                            break
+                        k -= 1
+                    inner = self._compose(tables, levels, k)
+                    inner = plug.translate(inner).translate(plug)
+            r = out[into[c] ^ 1]
+            if inner is not None:
+                r = out[into[inner[r]] ^ 1]
+            res[i] = r
+        offsets[-1] += len(data)
+        self.position += len(data)
+        return bytes(res)
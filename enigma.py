@@ -28,10 +28,15 @@ import json
 import hashlib
 import base64
 import zlib
+import functools
+import engine
 
 charset = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRS' \
           'TUVWXYZ !@#$%^&*()\'",./:;'
 
+# Where each letter sits in the charset, which is what the engine works with
+index = {c: i for i, c in enumerate(charset)}
+
 
 """
     These next few functions will attempt to build and work with
@@ -197,7 +202,19 @@ def write_key_file(key, filename):
 
 
 
-class Enigma:
+@functools.lru_cache(maxsize=64)
+def compile_key(key):
+    """
+        Builds the wiring for a text key once; every machine made with the
+        same key shares it.
+    """
+    return engine.compile_key(read_key(key), Rotor, PlugBoard)
+
+
+class Enigma(engine.Machine):
+    __slots__ = ()
+    charset = charset
+
     def __init__(self, key):
         """
             Takes the enigma key defined in keyformat which has been deciphered
@@ -205,94 +222,40 @@ class Enigma:
             python object. This object will then be used to create the enigma
             machine used to encrypt (and decrypt!) plaintext.
         """
-        self.key = read_key(key)
-        self.rotors = []
-        first = True
-        for r in self.key["rotors"]:
-            if first:
-                self.rotors.append(Rotor(tpose=r['rotor'],
-                                   start=r['start'], shift=r['shift']))
-                first = False
-            else:
-                self.rotors.append(Rotor(tpose=r['rotor'], start=r['start'],
-                                          shift=r['shift'], r=self.rotors[-1]))
-
-        # Build the plugboard
-        self.plugboard = PlugBoard(plugformat=self.key['plugboard'])
-        self.charset = charset
+        if type(key) is not str:
+            key = bytes(key)
+        super().__init__(compile_key(key))
 
     def transpose(self, data):
         """
-            Does the actual transposition of each individual letter.
-        """
-        res = ''
-        for c in data:
-            if c in self.charset:
-                r = self.plugboard.transpose(c)
-                r = self.rotors[-1].rotate(r)
-                r = self.plugboard.transpose(r)
-                res += r
-            else:
-                res += c
-        return res
-
-
-class PlugBoard:
-    def __init__(self, plugformat=None):
+            Does the actual transposition of each individual letter. Letters
+            outside of the charset are passed through untouched and don't
+            turn the rotors.
         """
-        Initializes a plugboard. The plugboard is a substitution cipher
-        that is fixed. It accepts a string as the plugformat parameter,
-        which should be specified as 'A-B|C-D|E-J' etc. The first letter
-        followed by a dash, then the letter it will transpose to. Note
-        that overlaps will be met with an Exception, so A -> B and B -> C
-        will throw an error and refuse to run. The plugformat must be
-        cyclical! A = B and B = A. An exception will be thrown if so.
-        The plugformat will be read in and missing letters will not be
-        transposed, but if one letter is transposed its compliment will
-        be transposed back automatically.
-        """
-        self.plugformat = plugformat
-        self.charset = charset
-        self.transpose_table = {}
-        self._build_plugboard()
-    
-    def _build_plugboard(self):
-        """
-        As stated, this builds the plugboard based on the plugformat
-        string.
-        """
-        # Zero this out just to be certain
-        self.transpose_table = {}
+        symbols = bytes(index[c] for c in data if c in index)
+        result = iter(super().transpose(symbols))
+        return ''.join(self.charset[next(result)] if c in index else c for c in data)
 
-        if self.plugformat is None:
-            # No substitution, call it a day.
-            for c in self.charset:
-                self.transpose_table[c] = c
-        else:
-            try:
-                for inst in self.plugformat.split('|'):
-                    if len(inst) == 3:
-                        i_from, i_to = inst.split('-')
-                        if i_from in self.transpose_table or i_to in self.transpose_table:
-                            # We have overlap!
-                            raise Exception("Overlap in plugboard format!")
-                        self.transpose_table[i_from] = i_to
-                        self.transpose_table[i_to] = i_from
-            except ValueError:
-                raise Exception("Please follow plugformat of a-b|c-d|d-e")
-            finally:
-                for c in self.charset:
-                    if c not in self.transpose_table:
-                        self.transpose_table[c] = c
-
-    def transpose(self, c):
+
+class PlugBoard(engine.PlugBoard):
+    charset = charset
+
+    def symbol(self, text):
         """
-        The official function to transpose a letter via the plugboard
+        Each side of a pair is a single letter, such as 'A-B|C-D'. Pairs
+        with anything longer have always been skipped.
         """
-        return self.transpose_table[c]
+        if len(text) != 1:
+            return None
+        if text not in index:
+            raise Exception("Plugboard letters must be in the charset!")
+        return index[text]
+
 
+class Rotor(engine.Rotor):
+    __slots__ = ()
+    charset = charset
 
-class Rotor:
     def __init__(self, tpose, start=0, shift=1, r=None):
         """
         Unnamed Rotor. This is a rotor that does not generate
@@ -305,61 +268,7 @@ class Rotor:
         r := pointer to another initialized rotor instance, this
              is the rotor next in line
         """
-        self.transpose_table = tpose
-        self.start = start
-        self.current = start
-        self.shift = shift
-        self.next_rotor = r
-        self.charset = charset
-        self._turn_rotor(self.start)
-
-    def _turn_rotor(self, amount):
-        """
-        Does nothing but turn the rotor <amount> times. Used for setting the
-        rotor.
-        """
-        # Rotate the rotor
-        r_charset = [self.transpose_table[k] for k in self.transpose_table]
-        r_charset = r_charset[amount%len(self.charset):] + r_charset[:amount%len(self.charset)]
-        left = [c for c in r_charset[:int(len(r_charset)/2)]]
-        right = [c for c in r_charset[int(len(r_charset)/2):]]
-        self.transpose_table = {}
-        for i,j in zip(left,right):
-            self.transpose_table[i] = j
-            self.transpose_table[j] = i
-
-        # for i,item in enumerate(self.charset):
-        #     self.transpose_table[item] = r_charset[i]
-
-    def transpose(self, c):
-        """
-            Does not rotate a rotor, just tranposes
-        """
-        if self.next_rotor is None:
-            return self.transpose_table[c]
-        else:
-            # This may technically cancel each other out, but ONLY if the rotor
-            # does not move. This allows the circuit to route through all the
-            # rotors AND BACK AGAIN.
-            return self.transpose_table[self.next_rotor.transpose(self.transpose_table[c])]
-
-
-    def rotate(self, c):
-        """
-        c := the character to get transposed
-        """
-        self._turn_rotor(self.shift)
-        self.current += self.shift
-
-        # If there is another rotor down the line, send the new transpose
-        if self.current > len(self.charset):
-            self.current %= len(self.charset)
-            if self.next_rotor is None:
-                return self.transpose_table[c]
-            else:
-                return self.transpose_table[self.next_rotor.rotate(self.transpose_table[c])]
-        else:
-            if self.next_rotor is None:
-                return self.transpose_table[c]
-            else:
-                return self.transpose_table[self.next_rotor.transpose(self.transpose_table[c])]
+        # The table is a dict and every turn rotates its values, so the
+        # engine needs to swap each zipped pair to keep them in value order.
+        super().__init__([index[c] for c in tpose.values()], start=start,
+                         shift=shift, r=r, size=len(charset), swap=True)
@@ -3,18 +3,175 @@
 """
 This file is the enigma code designed to read config and keys from
 a yaml file, rather than a key.
+
+Reading the YAML and rotor files every time a machine is made adds up when
+machines are made all the time, so a config can be compiled once into a
+Template, which machines are then stamped out of with no file I/O at all.
+A TemplateWatcher keeps a template up to date, compiling a new one in the
+background whenever the files it came from change and swapping it in.
 """
 
+import os
 import random
 import json
+import threading
+import types
 import yaml
+import engine
+import enigma
+from enigma import charset, PlugBoard
+
+
+def _freeze(value):
+    """
+        A read-only copy of the settings loaded from YAML, so a template
+        can hand the same settings to every machine it makes.
+    """
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def _stamp(filename):
+    """
+        Enough about a file to tell if it has changed, or None if it's gone.
+    """
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _load_settings(yaml_file):
+    try:
+        with open(yaml_file, 'r') as f:
+            return yaml.safe_load(f)
+    except FileNotFoundError:
+        raise Exception ("YAML file not found!")
+
+def _build(settings, generate=True):
+    """
+        Builds the wiring and plugboard from the settings. Unless told to
+        <generate> them, missing or unreadable rotor files are an error.
+    """
+    # TODO: maybe include the rotor setup in a state file or something.
+    # Maybe use a cryptographic hash to determine if the rotor state is correct?
+    rotors = ({'name': r['name'], 'start': r['start'], 'shift': r['shift'],
+               'generate': generate}
+              for r in settings['rotors'])
+    plugboard = PlugBoard(plugformat=settings['plugboard']['plugformat'])
+    return engine.build_wiring(rotors, plugboard.table, len(charset), Rotor), plugboard
+
+def compile_template(yaml_file):
+    """
+        Reads a YAML config, and the rotor files it names, into a Template.
+    """
+    return Template(yaml_file)
+
+
+class Template:
+    __slots__ = ('yaml_file', 'settings', 'plugboard', 'wiring', 'stamps')
+
+    def __init__(self, yaml_file):
+        """
+            Everything a machine needs from a YAML config, read in once.
+            Nothing in here changes after it's built, so one template can
+            make any number of machines, from any number of threads.
+        """
+        self.yaml_file = yaml_file
+        # Stamp the files before reading them, so a change made while they
+        # are being read still shows up in changed()
+        stamps = {yaml_file: _stamp(yaml_file)}
+        settings = _load_settings(yaml_file)
+        for r in settings['rotors']:
+            stamps[f"{r['name']}.enigma"] = _stamp(f"{r['name']}.enigma")
+        # A template is only ever compiled from files that are already there.
+        # Generating a stand-in rotor for one caught halfway through being
+        # written would overwrite it.
+        self.wiring, self.plugboard = _build(settings, generate=False)
+        self.settings = _freeze(settings)
+        self.stamps = types.MappingProxyType(stamps)
+
+    def changed(self):
+        """
+            Whether any of the files the template was built from has changed
+            since.
+        """
+        return any(_stamp(f) != stamp for f, stamp in self.stamps.items())
+
+    def machine(self):
+        """
+            A new machine at its initial state.
+        """
+        return Enigma.from_template(self)
+
+
+class TemplateWatcher:
+    def __init__(self, yaml_file, interval=1.0, watch=True):
+        """
+            Keeps a Template for <yaml_file> up to date. Every <interval>
+            seconds a background thread checks whether the files have
+            changed, and if so compiles a new template and swaps it in for
+            the old one in a single step, so machine() always stamps from
+            a complete template. If the new files can't be compiled (say,
+            halfway through being written) the old template stays in use
+            and the error is kept in self.error until the next good one.
+            Pass watch=False to only reload when reload() is called.
+        """
+        self.template = compile_template(yaml_file)
+        self.yaml_file = yaml_file
+        self.interval = interval
+        self.error = None
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if watch:
+            self._thread = threading.Thread(target=self._watch, daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            self.reload()
+
+    def reload(self, force=False):
+        """
+            Compiles and swaps in a new template if the files have changed
+            (or regardless, with <force>). Returns whether it did.
+        """
+        with self._lock:
+            if not force and not self.template.changed():
+                return False
+            try:
+                template = compile_template(self.yaml_file)
+            except Exception as e:
+                self.error = e
+                return False
+            self.template = template
+            self.error = None
+            self.reloads += 1
+            return True
+
+    def machine(self):
+        """
+            A new machine from the current template.
+        """
+        return self.template.machine()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
 
+    def __enter__(self):
+        return self
 
-charset = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRS' \
-          'TUVWXYZ !@#$%^&*()\'",./:;'
+    def __exit__(self, *exc):
+        self.close()
 
 
-class Enigma:
+class Enigma(enigma.Enigma):
     def __init__(self, yaml_file):
         """
         This is the function that starts it all up. By loading in
@@ -25,190 +182,66 @@ class Enigma:
         settings, but rather the initial rotor states. You would
         need to configure the rotor state and plugboard settings in
         a separate function to be used for encryption.
+
+        This reads the files every time. To make lots of machines from
+        the same config, compile it into a Template first.
         """
-        try:
-            with open(yaml_file, 'r') as f:
-                self.settings = yaml.safe_load(f)
-        except FileNotFoundError:
-            raise Exception ("YAML file not found!")
-        
-        # Build the rotor linkage.
-        # TODO: maybe include the rotor setup in a state file or something.
-        # Maybe use a cryptographic hash to determine if the rotor state is correct?
-        self.rotors = []
-        first = True
-        for r in self.settings['rotors']:
-            if first:
-                self.rotors.append(Rotor(name=r['name'],
-                                         start=r['start'], shift=r['shift']))
-                first = False
-            else:
-                self.rotors.append(Rotor(name=r['name'], start=r['start'],
-                                         shift=r['shift'], r=self.rotors[-1]))
-
-        # Build the plugboard
-        self.plugboard = PlugBoard(plugformat=self.settings['plugboard']['plugformat'])
+        self.settings = _load_settings(yaml_file)
+        wiring, self.plugboard = _build(self.settings)
 
         # I will need to make this a global var since everyone uses it, but
         # that's a bridge I'll burn at a later date
         self.charset = charset
+        engine.Machine.__init__(self, wiring)
 
-
-    def transpose(self, data):
-        """
-            Does the actual transposition of each individual letter.
-        """
-        res = ''
-        for c in data:
-            if c in self.charset:
-                r = self.plugboard.transpose(c)
-                r = self.rotors[-1].rotate(r)
-                r = self.plugboard.transpose(r)
-                res += r
-            else:
-                res += c
-        return res
-
-
-class PlugBoard:
-    def __init__(self, plugformat=None):
+    @classmethod
+    def from_template(cls, template):
         """
-        Initializes a plugboard. The plugboard is a substitution cipher
-        that is fixed. It accepts a string as the plugformat parameter,
-        which should be specified as 'A-B|C-D|E-J' etc. The first letter
-        followed by a dash, then the letter it will transpose to. Note
-        that overlaps will be met with an Exception, so A -> B and B -> C
-        will throw an error and refuse to run. The plugformat must be
-        cyclical! A = B and B = A. An exception will be thrown if so.
-        The plugformat will be read in and missing letters will not be
-        transposed, but if one letter is transposed its compliment will
-        be transposed back automatically.
+            Stamps out a machine from a compiled Template, which shares the
+            template's (read-only) settings, plugboard and wiring.
         """
-        self.plugformat = plugformat
-        self.charset = charset
-        self.transpose_table = {}
-        self._build_plugboard()
-    
-    def _build_plugboard(self):
-        """
-        As stated, this builds the plugboard based on the plugformat
-        string.
-        """
-        # Zero this out just to be certain
-        self.transpose_table = {}
-
-        if self.plugformat is None:
-            # No substitution, call it a day.
-            for c in self.charset:
-                self.transpose_table[c] = c
-        else:
-            try:
-                for inst in self.plugformat.split('|'):
-                    if len(inst) == 3:
-                        i_from, i_to = inst.split('-')
-                        if i_from in self.transpose_table or i_to in self.transpose_table:
-                            # We have overlap!
-                            raise Exception("Overlap in plugboard format!")
-                        self.transpose_table[i_from] = i_to
-                        self.transpose_table[i_to] = i_from
-            except ValueError:
-                raise Exception("Please follow plugformat of a-b|c-d|d-e")
-            finally:
-                for c in self.charset:
-                    if c not in self.transpose_table:
-                        self.transpose_table[c] = c
+        machine = cls.__new__(cls)
+        machine.settings = template.settings
+        machine.plugboard = template.plugboard
+        machine.charset = charset
+        engine.Machine.__init__(machine, template.wiring)
+        return machine
 
-    def transpose(self, c):
-        """
-        The official function to transpose a letter via the plugboard
-        """
-        return self.transpose_table[c]
 
+class Rotor(enigma.Rotor):
+    __slots__ = ('name',)
 
-class Rotor:
-    def __init__(self, name, start=0, shift=1, r=None):
+    def __init__(self, name, start=0, shift=1, r=None, generate=True):
         """
         name := name of the rotor, usually I, II, III, IV, etc
         start := what position to set the rotor to
         r := pointer to another initialized rotor instance, this
              is the rotor next in line
+        generate := whether to make (and write out) a random rotor if its
+                    file is missing or unreadable, rather than fail
         """
         self.name = name
-        self.start = start
-        self.current = start
-        self.shift = shift
-        self.next_rotor = r
-        self.charset = charset
         try:
             with open(f"{self.name}.enigma", "r") as f:
-                self.transpose_table = json.load(f)
+                tpose = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
-            self._build_transpose_table()
-        self._turn_rotor(self.start)
+            if not generate:
+                raise Exception(f"Rotor file {self.name}.enigma is missing or unreadable!")
+            tpose = self._build_transpose_table()
+        super().__init__(tpose, start=start, shift=shift, r=r)
 
     def _build_transpose_table(self):
-        r = [c for c in self.charset]
+        r = [c for c in charset]
         random.shuffle(r)
         left = [c for c in r[:int(len(r)/2)]]
         right = [c for c in r[int(len(r)/2):]]
-        self.transpose_table = {}
+        transpose_table = {}
         for i,j in zip(left,right):
-            self.transpose_table[i] = j
-            self.transpose_table[j] = i
+            transpose_table[i] = j
+            transpose_table[j] = i
         # self.transpose_table = {}
         # for i, char in enumerate(self.charset):
         #     self.transpose_table[char] = r[i]
         with open(f"{self.name}.enigma", "w") as f:
-            json.dump(self.transpose_table, f)
-
-    def _turn_rotor(self, amount):
-        """
-        Does nothing but turn the rotor <amount> times. Used for setting the
-        rotor.
-        """
-        # Rotate the rotor
-        r_charset = [self.transpose_table[k] for k in self.transpose_table]
-        r_charset = r_charset[amount%len(self.charset):] + r_charset[:amount%len(self.charset)]
-        left = [c for c in r_charset[:int(len(r_charset)/2)]]
-        right = [c for c in r_charset[int(len(r_charset)/2):]]
-        self.transpose_table = {}
-        for i,j in zip(left,right):
-            self.transpose_table[i] = j
-            self.transpose_table[j] = i
-
-        # for i,item in enumerate(self.charset):
-        #     self.transpose_table[item] = r_charset[i]
-
-    def transpose(self, c):
-        """
-            Does not rotate a rotor, just tranposes
-        """
-        if self.next_rotor is None:
-            return self.transpose_table[c]
-        else:
-            # This would otherwise seem to cancel each other out, but
-            # because the final rotor serves as a reflection plate,
-            # it will continue to transpose even further back up the
-            # chain, and still remain
-            return self.transpose_table[self.next_rotor.transpose(self.transpose_table[c])]
-
-
-    def rotate(self, c):
-        """
-        c := the character to get transposed
-        """
-        self._turn_rotor(self.shift)
-        self.current += self.shift
-
-        # If there is another rotor down the line, send the new transpose
-        if self.current > len(self.charset):
-            self.current %= len(self.charset)
-            if self.next_rotor is None:
-                return self.transpose_table[c]
-            else:
-                return self.transpose_table[self.next_rotor.rotate(self.transpose_table[c])]
-        else:
-            if self.next_rotor is None:
-                return self.transpose_table[c]
-            else:
-                return self.transpose_table[self.next_rotor.transpose(self.transpose_table[c])]
\ No newline at end of file
+            json.dump(transpose_table, f)
+        return transpose_table
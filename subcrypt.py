@@ -9,18 +9,35 @@
     for the substitution will be required to encrypt and decrypt.
 """
 
-import random
 import json
 import hashlib
 import base64
+import binascii
 import zlib
+import functools
+import time
+import contextlib
+import collections
+import errno
+import io
+import os
+import mmap
+import struct
+import operator
+import engine
 
 charset = [i for i in range(256)]
+# Keys made before version 2 have no version in them. The plugboard of
+# the builds that made them never applied any of its pairs, so for those
+# keys it is left out (see _plugformat()) to keep reading what they wrote.
+KEY_VERSION = 2
 
 def generate_key(max_plugs=20, max_rotors=10):
     """
         Generates a "key" for the pynigma cipher.
     """
+    # Only needed here, so it isn't imported by everyone just reading a key
+    import random
 
     # Some assertions:
     try:
@@ -67,7 +84,8 @@ def generate_key(max_plugs=20, max_rotors=10):
 
     # Now put it all together
 
-    result = { "plugboard": json.dumps(plugformat), "rotors": json.dumps(rotors) }
+    result = { "version": KEY_VERSION, "plugboard": json.dumps(plugformat),
+               "rotors": json.dumps(rotors) }
     result = json.dumps(result).encode('utf-8')
     return base64.b64encode(zlib.compress(result))
 
@@ -148,8 +166,329 @@ def write_key_file(key, filename):
             f.write(key[i:i+KEY_WIDTH]+b"\n")
         f.write(END_KEY+b"\n")
 
+def key_fingerprint(key):
+    """
+        A short fingerprint identifying a key, without giving the key away.
+    """
+    if type(key) is str:
+        key = key.encode()
+    return hashlib.sha256(bytes(key)).hexdigest()[:16]
+
+
+"""
+    Optional compression stage. Compressing before transposing cuts down on
+    the number of bytes that have to go through the rotors, which is where
+    nearly all of the time goes. The method used is recorded in a small
+    header at the front of the stream, which is transposed along with
+    everything else, so transposing the stream back finds the header and
+    decompresses on its own.
+"""
+
+COMPRESS_MAGIC = b"\x00PYNIGMA-COMPRESSED\x00"
+
+def _lzma_compressor():
+    # lzma is only imported by streams that use it
+    import lzma
+    return lzma.LZMACompressor()
+
+def _lzma_decompressor():
+    import lzma
+    return lzma.LZMADecompressor()
+
+COMPRESSORS = {
+    "zlib": (zlib.compressobj, zlib.decompressobj),
+    "lzma": (_lzma_compressor, _lzma_decompressor),
+}
+HEADER_PEEK = len(COMPRESS_MAGIC) + 1 + max(len(m) for m in COMPRESSORS)
+CHUNK_SIZE = 1024 * 1024
+
+def _compress_header(method):
+    name = method.encode()
+    return COMPRESS_MAGIC + bytes([len(name)]) + name
+
+def compression_of(head):
+    """
+        Given the first (already transposed back) bytes of a stream, returns
+        the compression method recorded there and the length of the header,
+        or (None, 0) if the stream was not compressed.
+    """
+    if not head.startswith(COMPRESS_MAGIC) or len(head) <= len(COMPRESS_MAGIC):
+        return None, 0
+    length = head[len(COMPRESS_MAGIC)]
+    end = len(COMPRESS_MAGIC) + 1 + length
+    method = head[len(COMPRESS_MAGIC)+1:end].decode(errors="replace")
+    if len(head) < end or method not in COMPRESSORS:
+        return None, 0
+    return method, end
+
+def peek_compression(machine, head):
+    """
+        Checks whether transposing <head> (the start of a stream) reveals a
+        compression header, leaving the machine at its initial state.
+    """
+    machine.reset()
+    method, _ = compression_of(machine.transpose(head[:HEADER_PEEK]))
+    machine.reset()
+    return method
+
+
+"""
+    Optional ASCII armor, for sending transposed data over channels that
+    only take text. The armored stream is wrapped in BEGIN/END lines just
+    like a key file, with a header line saying how the lines in between
+    are encoded. Both directions work a line at a time, so streams of any
+    size can be armored without holding them in memory.
+"""
+
+BEGIN_MESSAGE = b"-----BEGIN PYNIGMA MESSAGE-----"
+END_MESSAGE = b"-----END PYNIGMA MESSAGE-----"
+ARMOR_PEEK = 64
+
+def _hex_lines(data):
+    return data.hex("\n", -32).encode() + b"\n" if data else b""
+
+def _unhex(text):
+    return bytes.fromhex(text.decode("ascii"))
+
+# How many bytes go on each line, and how lines are encoded and decoded
+ARMORS = {
+    "base64": (57, base64.encodebytes, binascii.a2b_base64),
+    "hex": (32, _hex_lines, _unhex),
+}
+
+def is_armored(head):
+    """
+        Whether a stream starting with <head> is armored.
+    """
+    return head.lstrip().startswith(BEGIN_MESSAGE)
+
+
+class Armor:
+    def __init__(self, method="base64"):
+        """
+            Armors a stream a piece at a time with the named method from
+            ARMORS. Feed it with update() and call finish() at the end; both
+            return whatever text is ready.
+        """
+        if method not in ARMORS:
+            raise Exception(f"Unknown armor: {method}")
+        self.method = method
+        self._width, self._encode, _ = ARMORS[method]
+        self._started = False
+        # Bytes held back until there are enough of them for a whole line
+        self._held = b""
+
+    def _start(self):
+        if self._started:
+            return b""
+        self._started = True
+        return BEGIN_MESSAGE + b"\nArmor: " + self.method.encode() + b"\n\n"
+
+    def update(self, data):
+        head = self._start()
+        if self._held:
+            data = self._held + data
+        cut = len(data) - len(data) % self._width
+        self._held = bytes(data[cut:])
+        return head + self._encode(memoryview(data)[:cut])
+
+    def finish(self):
+        head = self._start()
+        data, self._held = self._held, b""
+        return head + self._encode(data) + END_MESSAGE + b"\n"
+
+
+class Dearmor:
+    def __init__(self):
+        """
+            Takes the armor back off a stream written by Armor, working out
+            the method from its header. Feed it with update() and call
+            finish() at the end; both return whatever data is ready.
+        """
+        self._method = None
+        self._decode = None
+        self._begun = False
+        self._done = False
+        # Text held back until there is a whole line of it
+        self._held = b""
+
+    def _header(self):
+        """
+            Reads the BEGIN line and header lines, returning whether they
+            have all arrived yet.
+        """
+        while self._decode is None:
+            end = self._held.find(b"\n")
+            if end < 0:
+                return False
+            line, self._held = self._held[:end].strip(), self._held[end+1:]
+            if not self._begun:
+                self._begun = line.startswith(BEGIN_MESSAGE)
+                continue
+            if line:
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"armor":
+                    method = value.strip().decode(errors="replace")
+                    if method not in ARMORS:
+                        raise Exception(f"Unknown armor: {method}")
+                    self._method = method
+                continue
+            if self._method is None:
+                raise Exception("Armored message doesn't say how it was armored!")
+            self._decode = ARMORS[self._method][2]
+        return True
+
+    def _lines(self, text):
+        end = text.find(END_MESSAGE)
+        if end >= 0:
+            self._done = True
+            text = text[:end]
+        return self._decode(text)
+
+    def update(self, text):
+        if self._done:
+            return b""
+        self._held += text
+        if not self._header():
+            return b""
+        end = self._held.rfind(b"\n") + 1
+        text, self._held = self._held[:end], self._held[end:]
+        return self._lines(text)
+
+    def finish(self):
+        if self._done:
+            return b""
+        if not self._header() and not self._begun:
+            raise Exception("Input isn't armored, it has no BEGIN line!")
+        if not self._header() or END_MESSAGE not in self._held:
+            raise Exception("Armored message is missing its END line!")
+        text, self._held = self._held, b""
+        return self._lines(text)
+
+
+def rekey_stream(old, new, src, dst, chunk_size=CHUNK_SIZE):
+    """
+        Re-keys everything read from <src> into <dst>, see Rekey. Anything
+        compressed stays compressed, since the data is never decompressed on
+        the way through. Returns the number of bytes read.
+    """
+    machine = Rekey(old, new)
+    total = 0
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        total += len(data)
+        dst.write(machine.transpose(data))
+    return total
+
+def append_stream(machine, src, filename, chunk_size=CHUNK_SIZE):
+    """
+        Transposes everything read from <src> onto the end of the transposed
+        file <filename> (which is created if need be), carrying on from
+        where the file leaves off as if it had all been transposed in one
+        go. The machine is set straight to the file's length rather than
+        replaying what is already there, so this only costs as much as the
+        data being added. Compressed and armored files can't be carried on
+        like this. Returns the number of bytes appended.
+    """
+    with open(filename, "ab+") as dst:
+        size = dst.seek(0, os.SEEK_END)
+        if size:
+            dst.seek(0)
+            head = dst.read(max(HEADER_PEEK, ARMOR_PEEK))
+            dst.seek(size)
+            if is_armored(head) or peek_compression(machine, head) is not None:
+                raise Exception("Cannot append to a compressed or armored file!")
+        machine.seek(size)
+        total = 0
+        while True:
+            data = src.read(chunk_size)
+            if not data:
+                break
+            total += len(data)
+            dst.write(machine.transpose(data))
+    return total
+
+def transpose_stream(machine, src, dst, compress=None, chunk_size=CHUNK_SIZE, armor=None,
+                     dearmor=False):
+    """
+        Transposes everything read from the file object <src> into <dst> in
+        chunks, starting from the machine's current state. If <compress> names
+        one of the COMPRESSORS the data is compressed before being transposed.
+        Otherwise a stream that turns out to carry a compression header is
+        decompressed after being transposed back, and an exception is raised
+        if that stream is cut short. With <dearmor> the input is armored text
+        and is unwrapped first, and if <armor> names one of the ARMORS the
+        output is armored. Returns the number of bytes read from <src>.
+    """
+    stream = Transposer(machine, compress, armor, dearmor)
+    total = 0
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        total += len(data)
+        dst.write(stream.update(data))
+    dst.write(stream.finish())
+    return total
+
+
+
+"""
+    Pad files. The permutation a machine transposes each position with only
+    depends on the key and the position, so for the start of a stream they
+    can all be worked out ahead of time and written to a pad file. A
+    PaddedEnigma maps the file in and transposes anything inside the window
+    it covers with one lookup per byte, and steps the rotors as usual past
+    it. The header records which key the pad was made for (by fingerprint,
+    see key_fingerprint()) and how many positions it covers.
+"""
+
+PAD_MAGIC = b"PYNIGMA-PAD\x00"
+PAD_VERSION = 1
+# magic, version, charset size, window, key fingerprint
+PAD_HEADER = struct.Struct('<12sHHQ16s24x')
+
+def write_pad(key, filename, window, chunk=4096):
+    """
+        Works out the permutation for each of the first <window> positions
+        of <key> and writes them to a pad file, <chunk> positions at a time.
+        This needs numpy, and is meant to be run ahead of time.
+    """
+    import vector
+    wiring = compile_key(key if type(key) is str else bytes(key))
+    tables = vector.tables(wiring)
+    with open(filename, "wb") as f:
+        f.write(PAD_HEADER.pack(PAD_MAGIC, PAD_VERSION, wiring.size, window,
+                                key_fingerprint(key).encode()))
+        for position in range(0, window, chunk):
+            f.write(tables.permutations(position, min(chunk, window - position)).tobytes())
+
+
+def _plugformat(key):
+    """
+        Keys made before KEY_VERSION 2 were always read with an empty
+        plugboard, so they still are.
+    """
+    if key.get("version", 1) < 2:
+        return None
+    return key['plugboard']
+
+
+@functools.lru_cache(maxsize=64)
+def compile_key(key):
+    """
+        Cached engine.compile_key() for byte keys, reading their plugboard
+        the way the build that made them did.
+    """
+    return engine.compile_key(read_key(key), Rotor, PlugBoard, _plugformat)
+
+
+class Enigma(engine.Machine):
+    __slots__ = ()
+    charset = charset
 
-class Enigma:
     def __init__(self, key):
         """
             Takes the enigma key defined in keyformat which has been deciphered
@@ -157,96 +496,448 @@ class Enigma:
             python object. This object will then be used to create the enigma
             machine used to encrypt (and decrypt!) plaintext.
         """
-        self.key = read_key(key)
-        self.rotors = []
-        first = True
-        for r in self.key["rotors"]:
-            if first:
-                self.rotors.append(Rotor(tpose=r['rotor'],
-                                   start=r['start'], shift=r['shift']))
-                first = False
-            else:
-                self.rotors.append(Rotor(tpose=r['rotor'], start=r['start'],
-                                          shift=r['shift'], r=self.rotors[-1]))
-
-        # Build the plugboard
-        self.plugboard = PlugBoard(plugformat=self.key['plugboard'])
-        self.charset = charset
+        if type(key) is not str:
+            key = bytes(key)
+        super().__init__(compile_key(key))
+
+    def transpose(self, data):
+        """
+            Does the actual transposition of each individual byte. Since the
+            charset is every byte there is, bytes are their own indices.
+        """
+        if type(data) is str:
+            data = data.encode('utf-8')
+        return super().transpose(data)
+
+
+class ThreadedEnigma(Enigma):
+    __slots__ = ('executor', 'pieces')
+
+    # Anything shorter than this is quicker to transpose the ordinary way
+    THRESHOLD = 64 * 1024
+
+    def __init__(self, key, pieces=None, executor=None):
+        """
+            An Enigma that transposes large inputs with the numpy tables from
+            vector.py, cut into <pieces> stretches which are run side by side
+            on a thread pool (<executor>, or one shared by every caller).
+            numpy releases the GIL while it works, so this makes use of every
+            core from a single process. Needs numpy.
+        """
+        super().__init__(key)
+        self.pieces = pieces
+        self.executor = executor
 
     def transpose(self, data):
+        if type(data) is str:
+            data = data.encode('utf-8')
+        if len(data) < self.THRESHOLD:
+            return super().transpose(data)
+        import vector
+        res = vector.tables(self.wiring).transpose_threaded(self.position, data,
+                                                            self.executor, self.pieces)
+        self.seek(self.position + len(data))
+        return res
+
+
+class Pad:
+    def __init__(self, filename):
+        """
+            Maps in a pad file written by write_pad(). The tables are shared
+            by every process using the same file.
         """
-            Does the actual transposition of each individual letter.
+        try:
+            with open(filename, "rb") as f:
+                self.tables = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            raise Exception("Pad file not found!")
+        if len(self.tables) < PAD_HEADER.size:
+            raise Exception("Not a pad file!")
+        magic, version, self.size, self.window, fingerprint = \
+            PAD_HEADER.unpack_from(self.tables)
+        if magic != PAD_MAGIC or version != PAD_VERSION:
+            raise Exception("Not a pad file!")
+        if len(self.tables) != PAD_HEADER.size + self.window * self.size:
+            raise Exception("Pad file is the wrong length!")
+        self.fingerprint = fingerprint.decode()
+
+    def close(self):
+        self.tables.close()
+
+
+class PaddedEnigma(Enigma):
+    __slots__ = ('pad',)
+
+    def __init__(self, key, pad):
         """
-        res = b''
+            An Enigma that looks up positions inside a pad's window rather
+            than stepping its rotors, falling back on stepping past it.
+            <pad> is a Pad or the name of a pad file, and has to have been
+            made for the same key.
+        """
+        super().__init__(key)
+        if not isinstance(pad, Pad):
+            pad = Pad(pad)
+        if pad.fingerprint != key_fingerprint(key) or pad.size != len(charset):
+            raise Exception("Pad file was made for a different key!")
+        self.pad = pad
+
+    def transpose(self, data):
         if type(data) is str:
             data = data.encode('utf-8')
-        for c in data:
-            if c in self.charset:
-                r = self.plugboard.transpose(c)
-                r = self.rotors[-1].rotate(r)
-                r = self.plugboard.transpose(r)
-                res += bytes([r])
-            else:
-                res += bytes([c])
+        position = self.position
+        inside = max(0, min(len(data), self.pad.window - position))
+        if not inside:
+            return super().transpose(data)
+        # Position p's table starts at p * size past the header, and byte c
+        # of it is what c transposes to
+        size = self.pad.size
+        start = PAD_HEADER.size + position * size
+        lookups = map(operator.add, range(start, start + inside * size, size), data[:inside])
+        res = bytes(map(self.pad.tables.__getitem__, lookups))
+        self.seek(position + inside)
+        if inside < len(data):
+            res += super().transpose(data[inside:])
         return res
 
 
-class PlugBoard:
-    def __init__(self, plugformat=None):
-        """
-        Initializes a plugboard. The plugboard is a substitution cipher
-        that is fixed. It accepts a string as the plugformat parameter,
-        which should be specified as 'A-B|C-D|E-J' etc. The first letter
-        followed by a dash, then the letter it will transpose to. Note
-        that overlaps will be met with an Exception, so A -> B and B -> C
-        will throw an error and refuse to run. The plugformat must be
-        cyclical! A = B and B = A. An exception will be thrown if so.
-        The plugformat will be read in and missing letters will not be
-        transposed, but if one letter is transposed its compliment will
-        be transposed back automatically.
-        """
-        self.plugformat = plugformat
-        self.charset = charset
-        self.transpose_table = {}
-        self._build_plugboard()
-    
-    def _build_plugboard(self):
-        """
-        As stated, this builds the plugboard based on the plugformat
-        string.
-        """
-        # Zero this out just to be certain
-        self.transpose_table = {}
-
-        if self.plugformat is None:
-            # No substitution, call it a day.
-            for c in self.charset:
-                self.transpose_table[c] = c
-        else:
+class MachinePool:
+    def __init__(self, key, size=4):
+        """
+            A fixed set of machines for the same key which can be shared
+            between threads. A single Enigma can't be, since every call to
+            transpose() turns its rotors. Machines are handed out with
+            machine(), and once given back are reset to their initial
+            rotor settings rather than rebuilt.
+        """
+        # Only imported by code that shares machines between threads
+        import queue
+        import threading
+
+        if size < 1:
+            raise Exception("A machine pool needs at least one machine!")
+        self.size = size
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(Enigma(key))
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.exhausted = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    @contextlib.contextmanager
+    def machine(self, timeout=None):
+        """
+            Hands out a machine at its initial state for the length of a
+            with block, waiting (up to <timeout> seconds) if every machine
+            is in use.
+        """
+        import queue
+        started = time.perf_counter()
+        try:
+            machine = self._idle.get_nowait()
+            exhausted = False
+        except queue.Empty:
+            exhausted = True
             try:
-                for inst in self.plugformat.split('|'):
-                    if len(inst) == 3:
-                        i_from, i_to = inst.split('-')
-                        if i_from in self.transpose_table or i_to in self.transpose_table:
-                            # We have overlap!
-                            raise Exception("Overlap in plugboard format!")
-                        self.transpose_table[i_from] = i_to
-                        self.transpose_table[i_to] = i_from
-            except ValueError:
-                raise Exception("Please follow plugformat of a-b|c-d|d-e")
-            finally:
-                for c in self.charset:
-                    if c not in self.transpose_table:
-                        self.transpose_table[c] = c
+                machine = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    self.exhausted += 1
+                raise Exception("Timed out waiting for a machine!")
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.checkouts += 1
+            self.exhausted += exhausted
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        try:
+            yield machine
+        finally:
+            machine.reset()
+            self._idle.put(machine)
+
+    def stats(self):
+        """
+            How the pool has been doing: how many machines were handed out,
+            how many times none were free, and how long callers waited.
+        """
+        with self._lock:
+            return {"size": self.size,
+                    "idle": self._idle.qsize(),
+                    "checkouts": self.checkouts,
+                    "exhausted": self.exhausted,
+                    "wait_time": self.wait_time,
+                    "max_wait": self.max_wait,
+                    "mean_wait": self.wait_time / self.checkouts if self.checkouts else 0.0}
+
+
+class ResultCache:
+    def __init__(self, maxsize=1024, max_length=4096):
+        """
+            Remembers what messages transposed to from a key's initial rotor
+            settings, since that only depends on the key and the message.
+            Messages sent over and over (heartbeats, templates and the like)
+            then skip the rotors entirely. Holds at most <maxsize> results,
+            dropping the least recently used, and doesn't bother with
+            messages longer than <max_length> bytes. Safe to share between
+            threads.
+        """
+        import threading
+
+        if maxsize < 1:
+            raise Exception("A result cache needs room for at least one result!")
+        self.maxsize = maxsize
+        self.max_length = max_length
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def transpose(self, key, data):
+        """
+            Transposes <data> the same way a new Enigma(key) would.
+        """
+        if type(data) is str:
+            data = data.encode('utf-8')
+        if len(data) > self.max_length:
+            return Enigma(key).transpose(data)
+        entry = (key_fingerprint(key), hashlib.sha256(data).digest())
+        with self._lock:
+            result = self._results.get(entry)
+            if result is not None:
+                self._results.move_to_end(entry)
+                self.hits += 1
+                return result
+            self.misses += 1
+        result = Enigma(key).transpose(data)
+        with self._lock:
+            self._results[entry] = result
+            self._results.move_to_end(entry)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        """
+            How many results are held, and how many lookups found one.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._results),
+                    "maxsize": self.maxsize,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
 
-    def transpose(self, c):
+
+class Rekey:
+    def __init__(self, old, new):
         """
-        The official function to transpose a letter via the plugboard
+            Chains two machines, so data transposed with the <old> key comes
+            out transposed with the <new> one. The plaintext only ever exists
+            a chunk at a time in memory. Either argument may be a key or a
+            machine. The two are always kept at the same position, so this
+            can be used anywhere a machine would be, including seeking to
+            re-key a chunk in the middle of a file.
         """
-        return self.transpose_table[c]
+        self.old = old if isinstance(old, engine.Machine) else Enigma(old)
+        self.new = new if isinstance(new, engine.Machine) else Enigma(new)
+        self.new.seek(self.old.position)
+
+    @property
+    def position(self):
+        return self.old.position
+
+    def seek(self, position):
+        self.old.seek(position)
+        self.new.seek(position)
 
+    def reset(self):
+        self.seek(0)
+
+    def transpose(self, data):
+        return self.new.transpose(self.old.transpose(data))
+
+
+class Transposer:
+    def __init__(self, machine, compress=None, armor=None, dearmor=False):
+        """
+            Runs a stream through <machine> a piece at a time, along with the
+            compression and armor stages, for callers that can't hand
+            transpose_stream() a file object. With <dearmor> the input is
+            armored text, which is unwrapped before anything else. Feed it
+            with update() and call finish() at the end; both return whatever
+            output is ready.
+        """
+        if compress is not None and compress not in COMPRESSORS:
+            raise Exception(f"Unknown compression method: {compress}")
+        self.machine = machine
+        self.compress = compress
+        self._compressor = COMPRESSORS[compress][0]() if compress else None
+        self._decompressor = None
+        self._armor = Armor(armor) if armor else None
+        self._dearmor = Dearmor() if dearmor else None
+        self._started = False
+        # Data held back until there is enough of it to look for a header
+        self._head = b""
+
+    def _start(self):
+        """
+            Writes the header when compressing, or checks the data held back
+            for one otherwise.
+        """
+        self._started = True
+        if self._compressor is not None:
+            return self.machine.transpose(_compress_header(self.compress))
+        data, self._head = self.machine.transpose(self._head), b""
+        method, skip = compression_of(data)
+        if method is None:
+            return data
+        self._decompressor = COMPRESSORS[method][1]()
+        return self._decompressor.decompress(data[skip:])
+
+    def _unwrap(self, data, final=False):
+        """
+            Takes the armor off the input, when asked to.
+        """
+        if self._dearmor is None:
+            return data
+        data = self._dearmor.update(data)
+        return data + self._dearmor.finish() if final else data
+
+    def _transpose(self, data):
+        if self._compressor is not None:
+            head = b"" if self._started else self._start()
+            return head + self.machine.transpose(self._compressor.compress(data))
+        if not self._started:
+            self._head += data
+            if len(self._head) < HEADER_PEEK:
+                return b""
+            return self._start()
+        data = self.machine.transpose(data)
+        return self._decompressor.decompress(data) if self._decompressor else data
+
+    def update(self, data):
+        data = self._transpose(self._unwrap(data))
+        return self._armor.update(data) if self._armor is not None else data
+
+    def finish(self):
+        data = self._unwrap(b"", final=True)
+        data = self._transpose(data) if data else b""
+        if not self._started:
+            data += self._start()
+        if self._decompressor is not None and not self._decompressor.eof:
+            raise Exception("Compressed stream ends before it should, it may be truncated!")
+        if self._compressor is not None:
+            data += self.machine.transpose(self._compressor.flush())
+        if self._armor is not None:
+            data = self._armor.update(data) + self._armor.finish()
+        return data
+
+
+class EnigmaFile(io.RawIOBase):
+    def __init__(self, path, key, mode="rb"):
+        """
+            A file whose contents are transposed on the way in and out, so
+            a transposed file can be handed straight to anything that reads
+            or writes files (tarfile, zipfile and so on). <key> may be a key
+            or a machine. <mode> is as for open(), always binary. Every read
+            or write sets the machine to the file position first and only
+            transposes the bytes asked for, so seeking around only costs
+            the bytes actually read or written. Nothing is read ahead; wrap
+            in io.BufferedReader (or similar) for that, and for readline()
+            and friends to be quick. Only plain transposed files can be used
+            this way, not compressed or armored ones.
+        """
+        super().__init__()
+        if 't' in mode:
+            raise Exception("EnigmaFile only works in binary mode!")
+        self._file = open(path, mode.replace('b', '') + 'b', buffering=0)
+        self.name = path
+        self.mode = self._file.mode
+        self.machine = key if hasattr(key, "transpose") else Enigma(key)
+        self._append = 'a' in mode
+        self._pos = self._file.tell()
+
+    def readable(self):
+        return self._file.readable()
+
+    def writable(self):
+        return self._file.writable()
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._checkClosed()
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self._file.fileno()).st_size
+        elif whence != os.SEEK_SET:
+            raise ValueError(f"Unknown whence: {whence}")
+        # The same exceptions as FileIO, which readers like zipfile rely on
+        if offset < 0:
+            raise OSError(errno.EINVAL, "Cannot seek to a negative position!")
+        self._pos = offset
+        return offset
+
+    def readinto(self, b):
+        self._checkClosed()
+        if not self.readable():
+            raise io.UnsupportedOperation("File not open for reading!")
+        with memoryview(b) as view, view.cast('B') as out:
+            self._file.seek(self._pos)
+            data = self._file.read(len(out))
+            self.machine.seek(self._pos)
+            out[:len(data)] = self.machine.transpose(data)
+        self._pos += len(data)
+        return len(data)
+
+    def write(self, b):
+        self._checkClosed()
+        if not self.writable():
+            raise io.UnsupportedOperation("File not open for writing!")
+        if self._append:
+            self._pos = os.fstat(self._file.fileno()).st_size
+        self._file.seek(self._pos)
+        self.machine.seek(self._pos)
+        n = self._file.write(self.machine.transpose(bytes(b)))
+        self._pos += n
+        return n
+
+    def truncate(self, size=None):
+        self._checkClosed()
+        return self._file.truncate(self._pos if size is None else size)
+
+    def close(self):
+        if not self.closed:
+            try:
+                super().close()
+            finally:
+                self._file.close()
+
+
+class PlugBoard(engine.PlugBoard):
+    # Since the charset is bytes, each side of a pair is a number, such as
+    # '12-200|3-4'
+    charset = charset
+
+
+class Rotor(engine.Rotor):
+    __slots__ = ()
+    charset = charset
 
-class Rotor:
     def __init__(self, tpose, start=0, shift=1, r=None):
         """
         Unnamed Rotor. This is a rotor that does not generate
@@ -259,62 +950,6 @@ class Rotor:
         r := pointer to another initialized rotor instance, this
              is the rotor next in line
         """
-        self.transpose_table = tpose
-        self.start = start
-        self.current = start
-        self.shift = shift
-        self.next_rotor = r
-        self.charset = charset
-        self._turn_rotor(self.start)
-
-    def _turn_rotor(self, amount):
-        """
-        Does nothing but turn the rotor <amount> times. Used for setting the
-        rotor.
-        """
-        # Rotate the rotor
-        # r_charset = [self.transpose_table[k] for k in self.transpose_table]
-        r_charset = [k for k in self.transpose_table]
-        r_charset = r_charset[amount%len(self.charset):] + r_charset[:amount%len(self.charset)]
-        left = [c for c in r_charset[:int(len(r_charset)/2)]]
-        right = [c for c in r_charset[int(len(r_charset)/2):]]
-        self.transpose_table = {}
-        for i,j in zip(left,right):
-            self.transpose_table[i] = j
-            self.transpose_table[j] = i
-
-        # for i,item in enumerate(self.charset):
-        #     self.transpose_table[item] = r_charset[i]
-
-    def transpose(self, c):
-        """
-            Does not rotate a rotor, just tranposes
-        """
-        if self.next_rotor is None:
-            return self.transpose_table[c]
-        else:
-            # This may technically cancel each other out, but ONLY if the rotor
-            # does not move. This allows the circuit to route through all the
-            # rotors AND BACK AGAIN.
-            return self.transpose_table[self.next_rotor.transpose(self.transpose_table[c])]
-
-
-    def rotate(self, c):
-        """
-        c := the character to get transposed
-        """
-        self._turn_rotor(self.shift)
-        self.current += self.shift
-
-        # If there is another rotor down the line, send the new transpose
-        if self.current > len(self.charset):
-            self.current %= len(self.charset)
-            if self.next_rotor is None:
-                return self.transpose_table[c]
-            else:
-                return self.transpose_table[self.next_rotor.rotate(self.transpose_table[c])]
-        else:
-            if self.next_rotor is None:
-                return self.transpose_table[c]
-            else:
-                return self.transpose_table[self.next_rotor.transpose(self.transpose_table[c])]
\ No newline at end of file
+        # The table is a list, so the first turn rotates its values, which
+        # then become the keys every turn after that rotates.
+        super().__init__(tpose, start=start, shift=shift, r=r, size=len(charset))
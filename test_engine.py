@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+"""
+    Checks the three front-ends (enigma.py, subcrypt.py and enigmayaml.py)
+    against output recorded from their implementations before they were
+    moved onto engine.py. The keys are built here from fixed tables rather
+    than generated, so the recorded output stays valid. There are keys
+    with slow rotors and keys whose rotors turn the next one over on nearly
+    every turn (or every turn, for shifts past the charset size), and the
+    text front-ends are given characters outside their charset.
+
+    The byte goldens were recorded with subcrypt.py as it was once the
+    plugboard was fixed (for version 2 keys) and before (for keys without
+    a version, which still transpose with an empty plugboard).
+
+    analysis.chain_period() is checked against the permutations a few
+    small machines actually step through.
+
+    Run with python -m pytest or python -m unittest.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import zlib
+
+import engine
+import enigma
+import enigmayaml
+import subcrypt
+
+
+def _pairs(size, a, b):
+    """
+        Pairs up the symbols 0..<size>-1 in the order i -> a*i + b (mod
+        size), which is a permutation as long as a and size share no
+        factors.
+    """
+    order = [(a * i + b) % size for i in range(size)]
+    return list(zip(order[0::2], order[1::2]))
+
+
+def byte_rotor(a, b):
+    table = [0] * 256
+    for i, j in _pairs(256, a, b):
+        table[i], table[j] = j, i
+    return table
+
+
+def text_rotor(a, b):
+    table = {}
+    for i, j in _pairs(len(enigma.charset), a, b):
+        table[enigma.charset[i]] = enigma.charset[j]
+        table[enigma.charset[j]] = enigma.charset[i]
+    return table
+
+
+def make_key(rotors, plugformat, version=None):
+    """
+        Packs (table, start, shift) rotors and a plugformat into a key, the
+        way generate_key() does.
+    """
+    packed = []
+    for table, start, shift in rotors:
+        r_setting = zlib.compress(json.dumps(table).encode('utf-8'))
+        packed.append({'rotor': base64.b64encode(r_setting).decode(),
+                       'checksum': hashlib.sha512(r_setting).hexdigest(),
+                       'start': start,
+                       'shift': shift})
+    result = {"plugboard": json.dumps(plugformat), "rotors": json.dumps(packed)}
+    if version is not None:
+        result["version"] = version
+    return base64.b64encode(zlib.compress(json.dumps(result).encode('utf-8')))
+
+
+BYTE_KEYS = {
+    "slow": ([(byte_rotor(3, 1), 5, 1), (byte_rotor(5, 7), 100, 3),
+              (byte_rotor(11, 0), 200, 7)], "12-200|3-4|0-255|65-97"),
+    "fast": ([(byte_rotor(7, 2), 1, 127), (byte_rotor(9, 40), 17, 255),
+              (byte_rotor(13, 5), 250, 300), (byte_rotor(15, 9), 33, 254)],
+             "1-2|100-101|7-250"),
+}
+
+TEXT_KEYS = {
+    "slow": ([(text_rotor(3, 1), 5, 1), (text_rotor(7, 4), 40, 3),
+              (text_rotor(11, 0), 70, 9)], "a-b|C-D|0-9"),
+    "fast": ([(text_rotor(3, 2), 1, 39), (text_rotor(9, 11), 13, 79),
+              (text_rotor(13, 5), 77, 100), (text_rotor(17, 3), 20, 78)],
+             "x-y|!-@|Q-R"),
+}
+
+YAML_CONFIG = """---
+name: "Golden"
+plugboard:
+  name: "board"
+  plugformat: "u-f|A-5|g-*|8-b|c-7"
+rotors:
+  - name: "Reflector"
+    start: 1
+    shift: 1
+  - name: "I"
+    start: 15
+    shift: 4
+  - name: "II"
+    start: 52
+    shift: 39
+  - name: "III"
+    start: 65
+    shift: 79
+"""
+YAML_ROTORS = {"Reflector": (3, 7), "I": (7, 1), "II": (11, 30), "III": (13, 2)}
+
+BYTES = bytes((i * 7 + i // 256) % 256 for i in range(5000))
+TEXT = ("Hello, World! Ünïcödé — tabs\tand\nnewlines stay put: [ok] ~ 42% "
+        "The quick brown fox jumps over the lazy dog. {curly} <angle> ")
+LONG_TEXT = TEXT * 40
+
+# sha256 of the output for BYTES, for version 2 keys and for keys without
+# a version
+GOLDEN_BYTES = {
+    'slow': '5d1f3b4c081a05876487d65394940e9253eeb3d8f0bbcb87ea0983df86d1140e',
+    'fast': '2e0fd5bca6174d98ab82033300edb5edcd1a8c2ec90211a5040b0522583e85e6',
+}
+GOLDEN_BYTES_LEGACY = {
+    'slow': '85298fbc429fc9744093e8a2f5de051466836e9afb5d373ef3002e64184b83bb',
+    'fast': '11a906582cf106e196ac1c611b18760bbd6b1689b8c693b983c496e3d3e010c7',
+}
+# The output for TEXT, and the sha256 of the output for LONG_TEXT
+GOLDEN_TEXT = {
+    'slow': '3SZ^2zB.e8fbK.ÜoïQö"éR—IUPdi\thg1\nfNo!4\'Kc.NYf,.vigAH[sQ]r~\'Zg1QP%8TGY4sG59HEq1ug9fj4i"e&,m,zw67YULGBV^f&L,Vv{yQoC0}S<*/PQ >a',
+    'fast': '@4"RAWCLeljZ^0Üzï)ö%é5—6hn7q\tM09\nR/J%m%86B*@ 7x3\'ni([)!]5~nTtBqF67F6$.BjU7kLIELmYClRhFfoAV("omfTH8q,lTOi7!pE{eniY8}C<6FoFL>G',
+}
+GOLDEN_LONG_TEXT = {
+    'slow': 'be806bc2c09ea8e2feac9f0550d049a7dd94b1a488e52366b347e4ce70b17669',
+    'fast': '50d4ab2e711372e12b96c20628573c3496a0c320b44fef383a0a2f254b9402eb',
+}
+GOLDEN_YAML = "3S(m3e9)mJZ8HZÜhï8öCéM—IV*Sw\tLx$\nq#@GNbteO7uCW!#;Sn7[4M]2~(Ztp!QR;XMqNRov^oF@6#nu&vJcl&j&:TSu1yp$'z!$lQP5WZU{b$Gd0}Z<ke(M&>0"
+GOLDEN_YAML_LONG = 'da0cc0f37e1783a79c49d7659d8b7506329080e83775cacb09c94248a705a252'
+
+
+def _sha(data):
+    if type(data) is str:
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class TestSubcrypt(unittest.TestCase):
+    def test_golden(self):
+        for name, (rotors, plugformat) in BYTE_KEYS.items():
+            key = make_key(rotors, plugformat, version=2)
+            out = subcrypt.Enigma(key).transpose(BYTES)
+            self.assertEqual(_sha(out), GOLDEN_BYTES[name], name)
+            self.assertEqual(subcrypt.Enigma(key).transpose(out), BYTES, name)
+
+    def test_golden_legacy(self):
+        for name, (rotors, plugformat) in BYTE_KEYS.items():
+            key = make_key(rotors, plugformat)
+            out = subcrypt.Enigma(key).transpose(BYTES)
+            self.assertEqual(_sha(out), GOLDEN_BYTES_LEGACY[name], name)
+
+    def test_pieces_and_seek(self):
+        key = make_key(*BYTE_KEYS["fast"], version=2)
+        whole = subcrypt.Enigma(key).transpose(BYTES)
+        machine = subcrypt.Enigma(key)
+        pieces = b"".join(machine.transpose(BYTES[i:i+777]) for i in range(0, len(BYTES), 777))
+        self.assertEqual(pieces, whole)
+        machine.seek(3001)
+        self.assertEqual(machine.transpose(BYTES[3001:]), whole[3001:])
+
+    def test_vector(self):
+        try:
+            import vector
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        for name, (rotors, plugformat) in BYTE_KEYS.items():
+            wiring = subcrypt.compile_key(make_key(rotors, plugformat, version=2))
+            out = vector.tables(wiring).transpose(0, BYTES)
+            self.assertEqual(_sha(out), GOLDEN_BYTES[name], name)
+
+
+class TestEnigma(unittest.TestCase):
+    def test_golden(self):
+        for name, (rotors, plugformat) in TEXT_KEYS.items():
+            key = make_key(rotors, plugformat)
+            out = enigma.Enigma(key).transpose(TEXT)
+            self.assertEqual(out, GOLDEN_TEXT[name], name)
+            self.assertEqual(enigma.Enigma(key).transpose(out), TEXT, name)
+            long = enigma.Enigma(key).transpose(LONG_TEXT)
+            self.assertEqual(_sha(long), GOLDEN_LONG_TEXT[name], name)
+
+
+class TestEnigmaYaml(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+        with open("golden.yaml", "w") as f:
+            f.write(YAML_CONFIG)
+        for name, (a, b) in YAML_ROTORS.items():
+            with open(f"{name}.enigma", "w") as f:
+                json.dump(text_rotor(a, b), f)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.dir.cleanup()
+
+    def test_golden(self):
+        out = enigmayaml.Enigma("golden.yaml").transpose(TEXT)
+        self.assertEqual(out, GOLDEN_YAML)
+        self.assertEqual(enigmayaml.Enigma("golden.yaml").transpose(out), TEXT)
+        long = enigmayaml.Enigma("golden.yaml").transpose(LONG_TEXT)
+        self.assertEqual(_sha(long), GOLDEN_YAML_LONG)
+
+    def test_template(self):
+        template = enigmayaml.compile_template("golden.yaml")
+        out = enigmayaml.Enigma.from_template(template).transpose(TEXT)
+        self.assertEqual(out, GOLDEN_YAML)
+
+
+class TestEnigmaFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "data.enc")
+        self.key = make_key(*BYTE_KEYS["fast"], version=2)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        with subcrypt.EnigmaFile(self.path, self.key, "wb") as f:
+            self.assertEqual(f.write(BYTES[:3000]), 3000)
+            f.seek(1000)
+            f.write(BYTES[1000:2000])
+            f.seek(0, os.SEEK_END)
+            f.write(BYTES[3000:])
+            self.assertEqual(f.tell(), len(BYTES))
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), subcrypt.Enigma(self.key).transpose(BYTES))
+        with subcrypt.EnigmaFile(self.path, self.key) as f:
+            self.assertEqual(f.read(), BYTES)
+            f.seek(4000)
+            self.assertEqual(f.read(16), BYTES[4000:4016])
+            f.seek(-10, os.SEEK_CUR)
+            self.assertEqual(f.tell(), 4006)
+            self.assertEqual(f.read(), BYTES[4006:])
+            f.seek(len(BYTES) + 10)
+            self.assertEqual(f.read(5), b"")
+            self.assertRaises(OSError, f.seek, -1)
+            self.assertRaises(ValueError, f.seek, 0, 3)
+
+    def test_append(self):
+        with subcrypt.EnigmaFile(self.path, self.key, "wb") as f:
+            f.write(BYTES[:1234])
+        with subcrypt.EnigmaFile(self.path, self.key, "ab") as f:
+            f.seek(0)
+            f.write(BYTES[1234:])
+        with subcrypt.EnigmaFile(self.path, self.key) as f:
+            self.assertEqual(f.read(), BYTES)
+
+    def test_archives(self):
+        for name in ("tar", "zip"):
+            buf = io.BytesIO()
+            if name == "tar":
+                with tarfile.open(fileobj=buf, mode="w") as tar:
+                    info = tarfile.TarInfo("bytes.bin")
+                    info.size = len(BYTES)
+                    tar.addfile(info, io.BytesIO(BYTES))
+            else:
+                with zipfile.ZipFile(buf, "w") as z:
+                    z.writestr("bytes.bin", BYTES)
+            with open(self.path, "wb") as f:
+                f.write(subcrypt.Enigma(self.key).transpose(buf.getvalue()))
+            with subcrypt.EnigmaFile(self.path, self.key) as f:
+                if name == "tar":
+                    with tarfile.open(fileobj=f) as tar:
+                        self.assertEqual(tar.extractfile("bytes.bin").read(), BYTES)
+                else:
+                    with zipfile.ZipFile(f) as z:
+                        self.assertEqual(z.read("bytes.bin"), BYTES)
+        # Too short to be a zip file, which zipfile finds out by seeking
+        # back from the end
+        with open(self.path, "wb") as f:
+            f.write(subcrypt.Enigma(self.key).transpose(b"not a zip"))
+        with subcrypt.EnigmaFile(self.path, self.key) as f:
+            self.assertFalse(zipfile.is_zipfile(f))
+
+
+class TestAnalysis(unittest.TestCase):
+    def test_chain_period(self):
+        try:
+            import analysis
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        # Small charsets, so the whole period fits in a few thousand
+        # positions and can be checked against the permutations themselves.
+        # Each rotor is (a, b, start, shift), with its ordering i -> a*i + b.
+        for size, rotors in ((16, [(5, 3, 3, 20), (7, 1, 1, 20)]),
+                             (16, [(3, 7, 7, 19), (9, 2, 9, 18), (11, 0, 1, 11)]),
+                             (16, [(13, 5, 2, 3), (5, 4, 4, 6), (7, 2, 3, 17)]),
+                             (256, [(3, 1, 5, 66)])):
+            chain = []
+            for a, b, start, shift in rotors:
+                order = [(a * i + b) % size for i in range(size)]
+                chain.append(engine.Rotor(order, start=start, shift=shift,
+                                          r=chain[-1] if chain else None, size=size))
+            wiring = engine.Wiring(chain, None, size)
+            period = analysis.chain_period(wiring)
+            perms = analysis.permutations(wiring, 3 * period, position=1000)
+            self.assertTrue((perms[period:] == perms[:-period]).all(), size)
+            shorter = [d for d in range(1, period) if period % d == 0
+                       and (perms[d:] == perms[:-d]).all()]
+            self.assertEqual(shorter, [], size)
+
+
+if __name__ == "__main__":
+    unittest.main()
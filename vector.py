@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+    NumPy versions of the engine's hot paths, for working on a lot of
+    symbols at once. Rather than stepping the rotors one symbol at a time
+    like engine.Machine does, every symbol's rotor turn counts are worked
+    out up front from its position, and each symbol is then run through
+    the whole chain of rotors with array gathers.
+
+    A rotor's state after n turns is its turn permutation applied n times,
+    which is just a walk of n steps around each of that permutation's
+    cycles. So each rotor keeps its cycles laid out end to end (twice
+    over, so a walk never has to wrap), where every symbol is along its
+    cycle, and how long that cycle is. There are only a handful of
+    different cycle lengths, so the turn counts are reduced modulo each
+    of those once per block rather than once per symbol.
+
+    The results are the same as engine.Machine.transpose() gives. Since
+    numpy lets go of the GIL while it works through an array, separate
+    stretches of a stream can be transposed on separate threads and make
+    use of every core without worker processes, see transpose_threaded().
+"""
+
+import functools
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# How many symbols are worked on at once. Small enough for the temporary
+# arrays to stay in cache.
+BLOCK = 1 << 14
+
+# The thread pool shared by everything that doesn't bring its own, made
+# when first needed
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _cycles(step, size):
+    """
+        Lays out the cycles of the permutation <step>, each one twice over.
+        Returns the layout, and for every symbol where its cycle starts in
+        the layout, how far along the cycle it is, and the cycle's length.
+    """
+    layout = []
+    start, along, length = [0] * size, [0] * size, [0] * size
+    seen = [False] * size
+    for i in range(size):
+        cycle = []
+        j = i
+        while not seen[j]:
+            seen[j] = True
+            cycle.append(j)
+            j = step[j]
+        for k, j in enumerate(cycle):
+            start[j] = len(layout)
+            along[j] = k
+            length[j] = len(cycle)
+        layout.extend(cycle * 2)
+    return (np.array(layout, np.intp), np.array(start, np.intp),
+            np.array(along, np.intp), np.array(length, np.intp))
+
+
+class RotorTables:
+    __slots__ = ('size', 'period', 'lengths', 'back', 'back_length',
+                 'forward', 'forward_length', 'layout', 'out', 'carried',
+                 'loop', 'lap', 'per_lap')
+
+    def __init__(self, rotor):
+        """
+            The arrays for one engine.Rotor. Running a symbol x through the
+            rotor after n turns is order[step^n(unstep^n(inverse[x]) ^ 1)],
+            where both walks are looked up in the cycle layout: back from
+            where inverse[x] sits and forward from where its pair partner
+            sits.
+        """
+        size = rotor.size
+        self.size = size
+        self.period = rotor.period
+        order = np.frombuffer(bytes(rotor.origin_order), np.uint8)[:size].astype(np.intp)
+        inverse = np.frombuffer(bytes(rotor.origin_inverse), np.uint8)[:size].astype(np.intp)
+        layout, start, along, length = _cycles(bytes(rotor.step), size)
+        self.lengths, which = np.unique(length, return_inverse=True)
+        # Offsets into the per-length rows of residues()
+        which = which.reshape(-1).astype(np.intp) * BLOCK
+
+        # Walking back n steps from position a of a cycle of length l ends
+        # up at a + l - (n mod l) in the doubled layout
+        self.back = (start + along + length)[inverse]
+        self.back_length = which[inverse]
+        partner = np.arange(size, dtype=np.intp) ^ 1
+        self.forward = (start + along)[partner]
+        self.forward_length = which[partner]
+        self.layout = layout
+        self.out = order[layout]
+
+        currents, carried, loop = rotor.schedule
+        self.carried = np.array(carried, np.int64)
+        self.loop = loop
+        self.lap = len(currents) - 1 - loop
+        self.per_lap = carried[loop + self.lap] - carried[loop]
+
+    def carries(self, turns):
+        """
+            How many times the rotor has turned the next one over after each
+            of <turns> turns, see engine.Rotor.counter().
+        """
+        laps, rest = np.divmod(np.maximum(turns - self.loop, 0), self.lap)
+        carries = self.carried[self.loop + rest] + laps * self.per_lap
+        if self.loop:
+            early = np.minimum(turns, self.loop)
+            carries = np.where(turns < self.loop, self.carried[early], carries)
+        return carries
+
+    def residues(self, turns):
+        """
+            <turns> (at most a BLOCK of them) modulo each of the rotor's
+            cycle lengths, one row of BLOCK per length.
+        """
+        turns = turns % self.period
+        res = np.zeros((len(self.lengths), BLOCK), np.intp)
+        for row, length in zip(res, self.lengths):
+            np.remainder(turns, length, out=row[:len(turns)])
+        return res.reshape(-1)
+
+    def apply(self, res, lanes, x):
+        """
+            Runs the symbols <x> through the rotor, where each symbol's turn
+            count is the one in column <lanes> of <res>.
+        """
+        x = self.layout.take(self.back.take(x) - res.take(self.back_length.take(x) + lanes))
+        return self.out.take(self.forward.take(x) + res.take(self.forward_length.take(x) + lanes))
+
+
+class Tables:
+    __slots__ = ('rotors', 'plug', 'size', 'chain')
+
+    def __init__(self, wiring):
+        """
+            The arrays for a whole engine.Wiring. Like the wiring, these
+            never change once built and can be shared freely.
+        """
+        self.rotors = [RotorTables(r) for r in wiring.rotors]
+        self.plug = np.frombuffer(bytes(wiring.plug), np.uint8).astype(np.intp)
+        self.size = wiring.size
+        # Symbols go through the leading rotor first, down to the deepest
+        # rotor and back out again
+        depth = len(self.rotors)
+        self.chain = list(range(depth - 1, -1, -1)) + list(range(1, depth))
+
+    def turns(self, position, count):
+        """
+            How many times each rotor has turned when the <count> symbols
+            from <position> on are transposed, as one array per rotor.
+        """
+        n = np.arange(position + 1, position + 1 + count, dtype=np.int64)
+        turns = [None] * len(self.rotors)
+        for k in range(len(self.rotors) - 1, -1, -1):
+            turns[k] = n
+            n = self.rotors[k].carries(n)
+        return turns
+
+    def _run(self, x, lanes, position, count):
+        """
+            Runs the symbols <x> through the plugboard and rotors, where
+            lane i holds the symbol(s) at <position> + i.
+        """
+        res = [r.residues(t) for r, t in zip(self.rotors, self.turns(position, count))]
+        x = self.plug.take(x)
+        for k in self.chain:
+            x = self.rotors[k].apply(res[k], lanes, x)
+        return self.plug.take(x)
+
+    def _transpose_into(self, position, src, res):
+        lanes = np.arange(BLOCK, dtype=np.intp)
+        for i in range(0, len(src), BLOCK):
+            count = min(BLOCK, len(src) - i)
+            res[i:i+count] = self._run(src[i:i+count], lanes[:count], position + i, count)
+
+    def transpose(self, position, data):
+        """
+            Transposes a sequence of symbol indices, the first of which is at
+            <position> in the stream, returning the result as bytes.
+        """
+        src = np.frombuffer(data, np.uint8)
+        res = np.empty(len(src), np.uint8)
+        self._transpose_into(position, src, res)
+        return res.tobytes()
+
+    def transpose_threaded(self, position, data, executor=None, pieces=None):
+        """
+            Like transpose(), but with the data cut into <pieces> stretches
+            (by default one per CPU) which are transposed side by side on
+            <executor>, or on a thread pool shared by every caller.
+        """
+        executor = executor or default_executor()
+        pieces = pieces or os.cpu_count() or 1
+        src = np.frombuffer(data, np.uint8)
+        res = np.empty(len(src), np.uint8)
+        # Whole blocks per piece, so no piece does a short block mid-stream
+        step = -(-len(src) // pieces // BLOCK) * BLOCK or BLOCK
+        futures = [executor.submit(self._transpose_into, position + i,
+                                   src[i:i+step], res[i:i+step])
+                   for i in range(0, len(src), step)]
+        for f in futures:
+            f.result()
+        return res.tobytes()
+
+    def permutations(self, position, count):
+        """
+            The permutation every position from <position> on transposes
+            symbols with, one row each for <count> positions.
+        """
+        res = np.empty((count, self.size), np.uint8)
+        per = max(1, BLOCK // self.size)
+        symbols = np.tile(np.arange(self.size, dtype=np.intp), per)
+        lanes = np.repeat(np.arange(per, dtype=np.intp), self.size)
+        for i in range(0, count, per):
+            n = min(per, count - i)
+            width = n * self.size
+            res[i:i+n] = self._run(symbols[:width], lanes[:width], position + i, n).reshape(n, self.size)
+        return res
+
+
+def default_executor():
+    """
+        The thread pool shared by everything not given one of its own, with
+        a thread for every CPU.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _executor
+
+
+@functools.lru_cache(maxsize=64)
+def tables(wiring):
+    """
+        The Tables for a wiring, built once and shared.
+    """
+    return Tables(wiring)